@@ -35,9 +35,9 @@ _fedpkg()
 
     local options="--help -v -q"
     local options_value="--dist --user --path"
-    local commands="ci clean clog clone co commit compile diff gimmespec giturl help \
-    import install lint local new new-sources patch prep pull push retire sources \
-    srpm switch-branch tag unused-patches upload verify-files verrel"
+    local commands="build-queue build-stats ci clean clog clone co commit compile diff gimmespec giturl help \
+    import import-batch install lint local new new-sources patch prep pull push retire sources \
+    srpm switch-branch sync tag unused-patches upload verify-files verrel"
 
     # parse main options and get command
 
@@ -93,15 +93,31 @@ _fedpkg()
     local after= after_more=
 
     case $command in
-        help|clog|gimmespec|giturl|lint|new|push|unused-patches|verrel)
+        help|clog|gimmespec|giturl|push|unused-patches|verrel)
+            ;;
+        build-queue)
+            options="--cache --order --plan"
+            options_arch="--arch"
+            options_string="--jobs --build-jobs"
+            options_dir="--logdir"
+            after="file"
+            after_more=true
+            ;;
+        build-stats)
+            options="--all"
+            options_string="--limit --threshold"
             ;;
         clean)
-            options="--dry-run -x"
+            options="--dry-run -x --artifacts"
+            options_string="--keep"
             ;;
         clone|co)
-            options="--branches --anonymous"
+            options="--branches --shared --anonymous --no-mirror --single-branch"
             options_branch="-b"
+            options_string="--jobs --depth --filter"
+            options_file="--from-file"
             after="package"
+            after_more=true
             ;;
         commit|ci)
             options="--push --clog --tag"
@@ -111,14 +127,22 @@ _fedpkg()
             after_more=true
             ;;
         compile|install)
-            options="--short-circuit"
+            options="--short-circuit --incremental --parallel-decompress --builddir-tmpfs --buildroot-tmpfs"
             options_arch="--arch"
             ;;
         diff)
-            options="--cached"
+            options="--cached --stat --stat-first"
             after="file"
             after_more=true
             ;;
+        new)
+            options="--stat --stat-first"
+            ;;
+        import-batch)
+            options_string="--jobs"
+            options_file="--report"
+            after="file"
+            ;;
         import)
             options="--create"
             options_branch="--branch"
@@ -126,9 +150,10 @@ _fedpkg()
             ;;
         lint)
             options="--info"
+            options_string="--jobs"
             ;;
         local)
-            options="--md5"
+            options="--md5 --cache --parallel-decompress --fast --no-debuginfo --builddir-tmpfs --buildroot-tmpfs"
             options_arch="--arch"
             ;;
         patch)
@@ -136,6 +161,7 @@ _fedpkg()
             options_string="--suffix"
             ;;
         prep)
+            options="--cache --parallel-decompress"
             options_arch="--arch"
             ;;
         pull)
@@ -149,12 +175,17 @@ _fedpkg()
             options_dir="--outdir"
             ;;
         srpm)
-            options="--md5"
+            options="--md5 --check"
             ;;
         switch-branch)
-            options="--list"
+            options="--list --worktree"
             after="branch"
             ;;
+        sync)
+            options="--rebase --push"
+            options_string="--jobs"
+            options_dir="--tree"
+            ;;
         tag)
             options="--clog --force --list --delete"
             options_string="--message"
@@ -257,8 +288,7 @@ _fedpkg_branch()
     [[ -n $1 ]] && git_options="--git-dir=$1/.git"
 
     git $git_options for-each-ref $format 'refs/remotes/origin/*/master' \
-        | sed 's,origin/\(.*\)/master,\1,'
-    git $git_options for-each-ref $format 'refs/heads'
+        'refs/heads' | sed 's,^origin/\(.*\)/master$,\1,'
 }
 
 have _fedpkg &&
@@ -22,6 +22,7 @@ import string
 import re
 import hashlib
 import textwrap
+import subprocess
 
 # See/put non-standard python imports down in __main__.  This lets us
 # generate the man page without needing extra stuff at build time.
@@ -55,6 +56,76 @@ def getuser(user=None):
     else:
         return os.getlogin()
 
+def page(lines):
+    # Feed lines to a pager on a tty as they come, or print them
+    if not sys.stdout.isatty():
+        for line in lines:
+            print(line)
+        return
+    pager = os.environ.get('PAGER', 'less -FRX')
+    proc = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE)
+    try:
+        for line in lines:
+            proc.stdin.write(line + '\n')
+    except IOError:
+        # The pager was quit before the end
+        lines.close()
+    finally:
+        # Also on errors, so the pager does not outlive us
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+
+def build_queue(args):
+    deps = None
+    try:
+        if args.order or args.plan:
+            graph = pyfedpkg.DepGraph(args.paths, args.jobs)
+            deps = graph.deps
+            if args.plan:
+                for level, paths in enumerate(graph.levels()):
+                    print('%s: %s' % (level, ' '.join(paths)))
+                return
+        results = pyfedpkg.build_queue(args.paths, jobs=args.jobs,
+                                       buildjobs=args.build_jobs,
+                                       logdir=args.logdir, deps=deps,
+                                       arch=args.arch, cache=args.cache)
+    except pyfedpkg.FedpkgError, e:
+        log.error('Could not run the build queue: %s' % e)
+        sys.exit(1)
+    failed = [path for path in args.paths
+              if results[os.path.abspath(path)] != 0]
+    print('%s of %s builds succeeded' % (len(results) - len(failed),
+                                         len(results)))
+    if failed:
+        print('Failed or skipped:\n  %s' % '\n  '.join(failed))
+        sys.exit(1)
+
+def build_stats(args):
+    module = None
+    try:
+        if not args.all:
+            module = pyfedpkg.PackageModule(args.path, args.dist).module
+        stats = pyfedpkg.BuildStats()
+        history = stats.history(module, args.limit)
+        regressions = stats.regressions(module, args.threshold)
+    except (pyfedpkg.FedpkgError, pyfedpkg.sqlite3.Error), e:
+        log.error('Could not read build stats: %s' % e)
+        sys.exit(1)
+    for (mod, nvr, arch, host, stage, short, started, duration, maxrss,
+         outsize) in history:
+        if short:
+            stage = '%s (short)' % stage
+        print('%s  %-40s %-8s %-16s %8.1fs %8d MiB %8d KiB  %s' %
+              (time.strftime('%Y-%m-%d %H:%M', time.localtime(started)),
+               nvr, arch, stage, duration, maxrss / 1024, outsize / 1024,
+               host))
+    for (mod, nvr, arch, host, stage, duration, median) in regressions:
+        log.warning('Regression: %s %s of %s on %s took %.1fs, up from '
+                    '%.1fs' % (stage, arch, nvr, host, duration, median))
+
 def check(args):
     # not implimented; Not planned
     log.warning('Not implimented yet, got %s' % args)
@@ -70,6 +141,8 @@ def clean(args):
         # create PackageModule object, for safety, not to run git clean if
         # outside package dir
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
+        if args.artifacts:
+            return pyfedpkg.clean_artifacts(args.path, args.keep, dry)
         return pyfedpkg.clean(dry, useignore)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not clean: %s' % e)
@@ -89,15 +162,51 @@ def clone(args):
         # Doing a try doesn't really work since the fedora_cert library just
         # exits on error, but if that gets fixed this will work better.
         user = getuser(args.user)
+    modules = list(args.module)
+    if args.from_file:
+        if args.from_file == '-':
+            input = sys.stdin
+        else:
+            input = open(args.from_file, 'r')
+        modules.extend([line.strip() for line in input.readlines()
+                        if line.strip() and not line.startswith('#')])
+    if not modules:
+        log.error('No module to clone given')
+        sys.exit(1)
+    if args.branches and args.filter:
+        log.error('Can not use --filter with --branches')
+        sys.exit(1)
+    if args.branches:
+        if len(modules) > 1:
+            log.error('Can not clone several modules with --branches')
+            sys.exit(1)
+    elif len(modules) > 1:
+        return clone_many(args, modules, user)
     try:
         if args.branches:
-            pyfedpkg.clone_with_dirs(args.module[0], user)
+            pyfedpkg.clone_with_dirs(modules[0], user, shared=args.shared,
+                                     jobs=args.jobs, depth=args.depth)
         else:
-            pyfedpkg.clone(args.module[0], user, args.path, args.branch)
+            pyfedpkg.clone(modules[0], user, args.path, args.branch,
+                           depth=args.depth, single_branch=args.single_branch,
+                           clonefilter=args.filter)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not clone: %s' % e)
         sys.exit(1)
 
+def clone_many(args, modules, user):
+    results = pyfedpkg.clone_many(modules, user, args.path, args.branch,
+                                  jobs=args.jobs, mirror=not args.no_mirror,
+                                  depth=args.depth,
+                                  single_branch=args.single_branch,
+                                  clonefilter=args.filter)
+    failed = [module for module in modules if results[module]]
+    print('Cloned %s of %s modules' % (len(modules) - len(failed),
+                                      len(modules)))
+    if failed:
+        print('Failed:\n  %s' % '\n  '.join(failed))
+        sys.exit(1)
+
 def commit(args):
     mymodule = None
     if args.clog:
@@ -134,14 +243,21 @@ def compile(args):
         short = True
     try:
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
-        return mymodule.compile(arch=arch, short=short)
+        if args.parallel_decompress:
+            mymodule.parallel_decompress()
+        if args.builddir_tmpfs or args.buildroot_tmpfs:
+            mymodule.use_tmpfs(buildroot=args.buildroot_tmpfs)
+        return mymodule.compile(arch=arch, short=short,
+                                incremental=args.incremental)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not compile: %s' % e)
         sys.exit(1)
 
 def diff(args):
     try:
-        return pyfedpkg.diff(args.path, args.cached, args.files)
+        return pyfedpkg.diff(args.path, args.cached, args.files,
+                             stat=args.stat or args.stat_first,
+                             patch=not args.stat)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not diff: %s' % e)
         sys.exit(1)
@@ -187,6 +303,25 @@ def import_srpm(args):
         print("Commit if happy or revert with: git reset --hard HEAD")
     return
 
+def import_batch(args):
+    user = getuser(args.user)
+    passwd = getpass.getpass('Password for %s: ' % user)
+    try:
+        results = pyfedpkg.import_batch(args.manifest, jobs=args.jobs,
+                                        user=user, passwd=passwd,
+                                        report=args.report)
+    except pyfedpkg.FedpkgError, e:
+        log.error('Could not import srpms: %s' % e)
+        sys.exit(1)
+    failed = 0
+    for result in results:
+        print('%-10s %s' % (result['status'], result['path']))
+        if result['status'] == 'failed':
+            failed += 1
+    print('%s imported, %s failed' % (len(results) - failed, failed))
+    if failed:
+        sys.exit(1)
+
 def install(args):
     arch = None
     short = False
@@ -196,7 +331,12 @@ def install(args):
         short = True
     try:
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
-        return mymodule.install(arch=arch, short=short)
+        if args.parallel_decompress:
+            mymodule.parallel_decompress()
+        if args.builddir_tmpfs or args.buildroot_tmpfs:
+            mymodule.use_tmpfs(buildroot=args.buildroot_tmpfs)
+        return mymodule.install(arch=arch, short=short,
+                                incremental=args.incremental)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not install: %s' % e)
         sys.exit(1)
@@ -204,7 +344,7 @@ def install(args):
 def lint(args):
     try:
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
-        return mymodule.lint(args.info)
+        return mymodule.lint(args.info, args.jobs)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not run rpmlint: %s' % e)
         sys.exit(1)
@@ -213,19 +353,29 @@ def local(args):
     arch = None
     if args.arch:
         arch = args.arch
+    # Skipping debuginfo only makes sense for a fast build
+    fast = args.fast or args.no_debuginfo
     try:
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
+        if args.parallel_decompress:
+            mymodule.parallel_decompress()
+        if args.builddir_tmpfs or args.buildroot_tmpfs:
+            mymodule.use_tmpfs(buildroot=args.buildroot_tmpfs)
         if args.md5:
-            return mymodule.local(arch=arch, hashtype='md5')
+            return mymodule.local(arch=arch, hashtype='md5', cache=args.cache,
+                                  fast=fast,
+                                  debuginfo=not args.no_debuginfo)
         else:
-            return mymodule.local(arch=arch)
+            return mymodule.local(arch=arch, cache=args.cache, fast=fast,
+                                  debuginfo=not args.no_debuginfo)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not build locally: %s' % e)
         sys.exit(1)
 
 def new(args):
     try:
-        print(pyfedpkg.new(args.path))
+        page(pyfedpkg.new(args.path, stat=args.stat or args.stat_first,
+                          patch=not args.stat))
     except pyfedpkg.FedpkgError, e:
         log.error('Could not get new changes: %s' % e)
         sys.exit(1)
@@ -256,7 +406,9 @@ def prep(args):
         arch = args.arch
     try:
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
-        return mymodule.prep(arch=arch)
+        if args.parallel_decompress:
+            mymodule.parallel_decompress()
+        return mymodule.prep(arch=arch, cache=args.cache)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not prep: %s' % e)
         sys.exit(1)
@@ -292,13 +444,19 @@ def sources(args):
         sys.exit(1)
 
 def srpm(args):
+    hashtype = None
+    if args.md5:
+        hashtype = 'md5'
     try:
         mymodule = pyfedpkg.PackageModule(args.path, args.dist)
+        if args.check:
+            if not mymodule.srpm_uptodate(hashtype):
+                log.info('srpm is out of date')
+                sys.exit(1)
+            log.info('srpm is up-to-date')
+            return
         pyfedpkg.sources(args.path)
-        if args.md5:
-            mymodule.srpm('md5')
-        else:
-            mymodule.srpm()
+        mymodule.srpm(hashtype)
     except pyfedpkg.FedpkgError, e:
         log.error('Could not make an srpm: %s' % e)
         sys.exit(1)
@@ -306,10 +464,13 @@ def srpm(args):
 def switch_branch(args):
     if args.branch:
         try:
-            pyfedpkg.switch_branch(args.branch, args.path)
+            path = pyfedpkg.switch_branch(args.branch, args.path,
+                                          worktree=args.worktree)
         except pyfedpkg.FedpkgError, e:
             log.error('Unable to switch to another branch: %s' % e)
             sys.exit(1)
+        if args.worktree:
+            print(path)
     else:
         try:
             (locals, remotes) = pyfedpkg._list_branches(path=args.path)
@@ -324,6 +485,28 @@ def switch_branch(args):
         print('Locals:\n%s\nRemotes:\n  %s' %
               ('\n'.join(locals), '\n  '.join(remotes)))
 
+def sync(args):
+    top = args.tree
+    if not top:
+        top = args.path
+    try:
+        results = pyfedpkg.sync_tree(top, push=args.push, rebase=args.rebase,
+                                     jobs=args.jobs)
+    except pyfedpkg.FedpkgError, e:
+        log.error('Could not sync: %s' % e)
+        sys.exit(1)
+    counts = {}
+    for path in sorted(results.keys()):
+        status, output = results[path]
+        counts[status] = counts.get(status, 0) + 1
+        print('%-10s %s' % (status, path))
+        if status in ('conflict', 'failed'):
+            log.debug(output)
+    print(', '.join(['%s %s' % (counts.get(status, 0), status) for status in
+                     ('updated', 'unchanged', 'conflict', 'failed')]))
+    if counts.get('conflict') or counts.get('failed'):
+        sys.exit(1)
+
 def tag(args):
     if args.list:
         try:
@@ -417,6 +600,69 @@ def parse_cmdline(generate_manpage = False):
     parser_help = subparsers.add_parser('help', help = 'Show usage')
     parser_help.set_defaults(command = usage)
 
+    # build a set of modules at once
+    parser_build_queue = subparsers.add_parser('build-queue',
+                                               help = 'Local test rpmbuild '
+                                               'of several modules',
+                                               description = 'Build the \
+                                               given module checkouts \
+                                               locally, several at a time.  \
+                                               The builds share a pool of \
+                                               job slots, so that together \
+                                               they do not use more cpus \
+                                               than asked for.  Each build \
+                                               is logged separately and a \
+                                               failed build does not stop \
+                                               the others.')
+    parser_build_queue.add_argument('--jobs', '-j', type = int,
+                                    default = None,
+                                    help = 'Total job slots to use, \
+                                    defaults to the number of cpus')
+    parser_build_queue.add_argument('--build-jobs', type = int,
+                                    default = None,
+                                    help = 'Job slots (make -j) of each \
+                                    build, defaults to splitting them \
+                                    between up to %s builds' %
+                                    pyfedpkg.BUILDQUEUEBUILDS)
+    parser_build_queue.add_argument('--logdir', default = None,
+                                    help = 'Directory for the build logs, \
+                                    defaults to each module directory')
+    parser_build_queue.add_argument('--arch', help = 'Build for arch')
+    parser_build_queue.add_argument('--cache', action = 'store_true',
+                                    help = 'Reuse and populate the local \
+                                    build cache')
+    parser_build_queue.add_argument('--order', action = 'store_true',
+                                    help = 'Build modules only after the \
+                                    modules providing their BuildRequires')
+    parser_build_queue.add_argument('--plan', action = 'store_true',
+                                    help = 'Only print the levels of the \
+                                    BuildRequires ordered build plan')
+    parser_build_queue.add_argument('paths', nargs = '+',
+                                    help = 'Module checkouts to build')
+    parser_build_queue.set_defaults(command = build_queue)
+
+    # show the build timing history
+    parser_build_stats = subparsers.add_parser('build-stats',
+                                               help = 'Show local build '
+                                               'timing history',
+                                               description = 'Show how long \
+                                               the recent prep, compile, \
+                                               install and local runs of \
+                                               the module took, with the \
+                                               peak memory use and package \
+                                               size, and warn about stages \
+                                               that got slower.')
+    parser_build_stats.add_argument('--all', action = 'store_true',
+                                    help = 'Show all modules, not just the \
+                                    current one')
+    parser_build_stats.add_argument('--limit', type = int, default = 20,
+                                    help = 'Number of runs to show')
+    parser_build_stats.add_argument('--threshold', type = float,
+                                    default = 1.2,
+                                    help = 'Slowdown over the recent median \
+                                    to report as a regression (default 1.2)')
+    parser_build_stats.set_defaults(command = build_stats)
+
     # check preps; not planned
     #parser_check = subparsers.add_parser('check',
     #                            help = 'Check test srpm preps on all arches')
@@ -433,6 +679,12 @@ def parse_cmdline(generate_manpage = False):
                               help = 'Perform a dry-run')
     parser_clean.add_argument('-x', action = 'store_true',
                               help = 'Do not follow .gitignore rules')
+    parser_clean.add_argument('--artifacts', action = 'store_true',
+                              help = 'Only remove packages of older local \
+                              builds instead of untracked files')
+    parser_clean.add_argument('--keep', type = int, default = 1,
+                              help = 'With --artifacts, number of most \
+                              recent builds to keep (default 1)')
     parser_clean.set_defaults(command = clean)
 
     # Create a changelog stub
@@ -459,6 +711,9 @@ def parse_cmdline(generate_manpage = False):
                               action = 'store_true',
                               help = 'Do an old style checkout with subdirs \
                               for branches')
+    parser_clone.add_argument('--shared', action = 'store_true',
+                              help = 'With --branches, share one object \
+                              store between the branch subdirs')
     # provide a convenient way to get to a specific branch
     parser_clone.add_argument('--branch', '-b',
                               help = 'Check out a specific branch')
@@ -466,9 +721,28 @@ def parse_cmdline(generate_manpage = False):
     parser_clone.add_argument('--anonymous', '-a',
                               action = 'store_true',
                               help = 'Check out a branch anonymously')
+    # fetch less than everything
+    parser_clone.add_argument('--depth', type = int, default = None,
+                              help = 'Only fetch the given number of commits \
+                              of history')
+    parser_clone.add_argument('--single-branch', action = 'store_true',
+                              help = 'Only fetch the branch being checked out')
+    parser_clone.add_argument('--filter', default = None,
+                              help = 'Partial clone filter, like blob:none, \
+                              to fetch file contents only when needed')
+    # clone many modules at once
+    parser_clone.add_argument('--jobs', '-j', type = int, default = None,
+                              help = 'Number of modules to clone at once, \
+                              defaults to the number of cpus')
+    parser_clone.add_argument('--from-file', '-f', default = None,
+                              help = 'Read module names from a file, one \
+                              per line, or from stdin if "-"')
+    parser_clone.add_argument('--no-mirror', action = 'store_true',
+                              help = 'When cloning several modules, do not \
+                              clone by reference to the local mirror cache')
     # store the module to be cloned
-    parser_clone.add_argument('module', nargs = 1,
-                              help = 'Name of the module to clone')
+    parser_clone.add_argument('module', nargs = '*',
+                              help = 'Name of the module(s) to clone')
     parser_clone.set_defaults(command = clone)
 
     parser_co = subparsers.add_parser('co', parents = [parser_clone],
@@ -543,6 +817,19 @@ def parse_cmdline(generate_manpage = False):
     parser_compile.add_argument('--arch', help = 'Arch to compile for')
     parser_compile.add_argument('--short-circuit', action = 'store_true',
                                 help = 'short-circuit compile')
+    parser_compile.add_argument('--incremental', action = 'store_true',
+                                help = 'Only rerun the stages whose spec \
+                                section or sources changed since the last \
+                                run, short-circuiting when possible')
+    parser_compile.add_argument('--parallel-decompress', action = 'store_true',
+                                help = 'Unpack sources with pigz, lbzip2/pbzip2 \
+                                or threaded xz when available')
+    parser_compile.add_argument('--builddir-tmpfs', action = 'store_true',
+                                help = 'Build in a tmpfs directory when there \
+                                is enough free memory')
+    parser_compile.add_argument('--buildroot-tmpfs', action = 'store_true',
+                                help = 'Put the buildroot on tmpfs too, \
+                                implies --builddir-tmpfs')
     parser_compile.set_defaults(command = compile)
 
     # export the module; not planned
@@ -562,6 +849,13 @@ def parse_cmdline(generate_manpage = False):
     parser_diff.add_argument('--cached', default = False,
                              action = 'store_true',
                              help = 'View staged changes')
+    parser_diff.add_argument('--stat', default = False,
+                             action = 'store_true',
+                             help = 'Only show a diffstat summary')
+    parser_diff.add_argument('--stat-first', default = False,
+                             action = 'store_true',
+                             help = 'Show a diffstat summary before the '
+                             'changes')
     parser_diff.add_argument('files', nargs = '*',
                              default = [],
                              help = 'Optionally diff specific files')
@@ -604,6 +898,32 @@ def parse_cmdline(generate_manpage = False):
                                     help = 'Source rpm to import')
     parser_import_srpm.set_defaults(command = import_srpm)
 
+    # Import many srpms at once
+    parser_import_batch = subparsers.add_parser('import-batch',
+                                                help = 'Import srpms into \
+                                                many modules at once',
+                                                description = 'This will \
+                                                import each srpm listed in a \
+                                                manifest into its module \
+                                                checkout and upload its \
+                                                sources, several at a time.  \
+                                                Each manifest line is an srpm \
+                                                and a module path.  Identical \
+                                                source files are uploaded \
+                                                only once.  The changes are \
+                                                staged, not committed.')
+    parser_import_batch.add_argument('--jobs', '-j', type = int,
+                                     default = None,
+                                     help = 'Number of srpms to import at \
+                                     once, defaults to the number of cpus')
+    parser_import_batch.add_argument('--report', default = None,
+                                     help = 'Write the results as JSON to \
+                                     this file')
+    parser_import_batch.add_argument('manifest',
+                                     help = 'File listing the srpms and \
+                                     module paths to import them into')
+    parser_import_batch.set_defaults(command = import_batch)
+
     # install locally
     parser_install = subparsers.add_parser('install',
                                            help = 'Local test rpmbuild install',
@@ -615,6 +935,19 @@ def parse_cmdline(generate_manpage = False):
     parser_install.add_argument('--arch', help = 'Arch to install for')
     parser_install.add_argument('--short-circuit', action = 'store_true',
                                 help = 'short-circuit install')
+    parser_install.add_argument('--incremental', action = 'store_true',
+                                help = 'Only rerun the stages whose spec \
+                                section or sources changed since the last \
+                                run, short-circuiting when possible')
+    parser_install.add_argument('--parallel-decompress', action = 'store_true',
+                                help = 'Unpack sources with pigz, lbzip2/pbzip2 \
+                                or threaded xz when available')
+    parser_install.add_argument('--builddir-tmpfs', action = 'store_true',
+                                help = 'Build in a tmpfs directory when there \
+                                is enough free memory')
+    parser_install.add_argument('--buildroot-tmpfs', action = 'store_true',
+                                help = 'Put the buildroot on tmpfs too, \
+                                implies --builddir-tmpfs')
     parser_install.set_defaults(command = install)
 
     # rpmlint target
@@ -625,6 +958,10 @@ def parse_cmdline(generate_manpage = False):
                              default = False,
                              action = 'store_true',
                              help = 'Display explanations for reported messages')
+    parser_lint.add_argument('--jobs', '-j', type = int,
+                             default = None,
+                             help = 'Number of rpmlint processes to run at \
+                             once, defaults to the number of cpus')
     parser_lint.set_defaults(command = lint)
 
     # Build locally
@@ -639,6 +976,25 @@ def parse_cmdline(generate_manpage = False):
     # optionally define old style hashsums
     parser_local.add_argument('--md5', action = 'store_true',
                               help = 'Use md5 checksums (for older rpm hosts)')
+    parser_local.add_argument('--cache', action = 'store_true',
+                              help = 'Reuse the result of an earlier build \
+                              with identical inputs, and cache this one')
+    parser_local.add_argument('--parallel-decompress', action = 'store_true',
+                              help = 'Unpack sources with pigz, lbzip2/pbzip2 \
+                              or threaded xz when available')
+    parser_local.add_argument('--fast', action = 'store_true',
+                              help = 'Use cheap payload compression for a \
+                              quick test build.  The packages are tagged as \
+                              not for release')
+    parser_local.add_argument('--no-debuginfo', action = 'store_true',
+                              help = 'Skip debuginfo packages and \
+                              stripping, implies --fast')
+    parser_local.add_argument('--builddir-tmpfs', action = 'store_true',
+                              help = 'Build in a tmpfs directory when there \
+                              is enough free memory')
+    parser_local.add_argument('--buildroot-tmpfs', action = 'store_true',
+                              help = 'Put the buildroot on tmpfs too, \
+                              implies --builddir-tmpfs')
     parser_local.set_defaults(command = local)
 
     # See what's different
@@ -647,7 +1003,18 @@ def parse_cmdline(generate_manpage = False):
                                        description = 'This will use git to \
                                        show a diff of all the changes \
                                        (even uncommited changes) since the \
-                                       last git tag was applied.')
+                                       last git tag was applied.  The \
+                                       diff is paged on a tty.  Rename \
+                                       detection is skipped when over \
+                                       %s files changed.' %
+                                       pyfedpkg.DIFFRENAMEMAX)
+    parser_new.add_argument('--stat', default = False,
+                            action = 'store_true',
+                            help = 'Only show a diffstat summary')
+    parser_new.add_argument('--stat-first', default = False,
+                            action = 'store_true',
+                            help = 'Show a diffstat summary before the '
+                            'changes')
     parser_new.set_defaults(command = new)
 
     # newsources target takes one or more files as input
@@ -679,6 +1046,13 @@ def parse_cmdline(generate_manpage = False):
                                         the sources (unpack the source \
                                         archive(s) and apply any patches.)')
     parser_prep.add_argument('--arch', help = 'Prep for a specific arch')
+    parser_prep.add_argument('--cache', action = 'store_true',
+                             help = 'Restore the prepped tree from the cache \
+                             when the sources, patches and %%prep are \
+                             unchanged, and cache it otherwise')
+    parser_prep.add_argument('--parallel-decompress', action = 'store_true',
+                             help = 'Unpack sources with pigz, lbzip2/pbzip2 \
+                             or threaded xz when available')
     parser_prep.set_defaults(command = prep)
 
     # Pull stuff
@@ -734,10 +1108,19 @@ def parse_cmdline(generate_manpage = False):
 
     # srpm creates a source rpm from the module content
     parser_srpm = subparsers.add_parser('srpm',
-                                        help = 'Create a source rpm')
+                                        help = 'Create a source rpm',
+                                        description = 'Create a source rpm \
+                                        from the module content.  The srpm \
+                                        is only rebuilt when the spec, \
+                                        patches, sources or rpm defines \
+                                        differ from the manifest stored \
+                                        next to it.')
     # optionally define old style hashsums
     parser_srpm.add_argument('--md5', action = 'store_true',
                              help = 'Use md5 checksums (for older rpm hosts)')
+    parser_srpm.add_argument('--check', action = 'store_true',
+                             help = 'Only check if the srpm is up-to-date, \
+                             exit non-zero if it needs rebuilding')
     parser_srpm.set_defaults(command = srpm)
 
     # switch branches
@@ -754,8 +1137,39 @@ def parse_cmdline(generate_manpage = False):
     parser_switchbranch.add_argument('-l', '--list',
                                 help = 'List both remote-tracking branches and local branches',
                                 action = 'store_true')
+    parser_switchbranch.add_argument('--worktree', '-w',
+                                     help = 'Check the branch out in its \
+                                     own worktree under %s instead of \
+                                     switching in place, and print its \
+                                     path.  %s/%s links to the last one.' %
+                                     (pyfedpkg.WORKTREEDIR,
+                                      pyfedpkg.WORKTREEDIR,
+                                      pyfedpkg.WORKTREELINK),
+                                     action = 'store_true')
     parser_switchbranch.set_defaults(command = switch_branch)
 
+    # sync a whole tree of checkouts
+    parser_sync = subparsers.add_parser('sync',
+                                        help = 'Pull or push all module \
+                                        checkouts in a directory tree',
+                                        description = 'This command finds \
+                                        every module checkout below a \
+                                        directory and pulls (or pushes) them \
+                                        several at a time, then reports \
+                                        which were updated, unchanged, hit \
+                                        conflicts or failed.')
+    parser_sync.add_argument('--tree', default = None,
+                             help = 'Directory to look for checkouts in, \
+                             defaults to --path or the current dir')
+    parser_sync.add_argument('--jobs', '-j', type = int, default = None,
+                             help = 'Number of checkouts to sync at once')
+    parser_sync.add_argument('--rebase', action = 'store_true',
+                             help = 'Rebase local changes on top of the \
+                             pulled ones')
+    parser_sync.add_argument('--push', action = 'store_true',
+                             help = 'Push instead of pull')
+    parser_sync.set_defaults(command = sync)
+
     # tag stuff
     parser_tag = subparsers.add_parser('tag',
                                        help = 'Management of git tags',
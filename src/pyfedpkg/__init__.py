@@ -24,6 +24,20 @@ import stat
 import StringIO
 import OpenSSL
 import fnmatch
+import errno
+import time
+import multiprocessing
+import multiprocessing.pool
+import socket
+import sqlite3
+import tempfile
+import fcntl
+import zlib
+import bz2
+import struct
+import signal
+import json
+import threading
 
 # Define some global variables, put them here to make it easy to change
 LOOKASIDE = 'http://distfiles.pld-linux.org'
@@ -37,6 +51,77 @@ UPLOADEXTS = ['tar', 'gz', 'bz2', 'lzma', 'xz', 'Z', 'zip', 'tff', 'bin',
               'tbz', 'tbz2', 'tgz', 'tlz', 'txz', 'pdf', 'rpm', 'jar', 'war',
               'db', 'cpio', 'jisp', 'egg', 'gem']
 BRANCHFILTER = 'f\d\d\/master|master|el\d\/master|olpc\d\/master'
+# Hash type used for build input manifests
+MANIFESTHASH = 'sha256'
+# Where local build results are cached, and how big the cache may grow
+BUILDCACHE = os.path.expanduser('~/.cache/fedpkg/builds')
+BUILDCACHESIZE = 10 * 1024 * 1024 * 1024
+# Macros whose values are part of the local build cache key
+BUILDCACHEMACROS = ['%{?dist}', '%{_target_cpu}', '%{optflags}']
+# Defined macros left out of build input manifests, as they only say where
+# a checkout builds, which tools unpack the sources or how many jobs make
+# runs, not what is built
+MANIFESTSKIPMACROS = ['_sourcedir', '_specdir', '_builddir', '_srcrpmdir',
+                      '_rpmdir', '_buildrootdir', '__gzip', '__bzip2', '__xz',
+                      '_smp_mflags']
+# Where build trees left by %prep are cached, and how big the cache may grow
+PREPCACHE = os.path.expanduser('~/.cache/fedpkg/prep')
+PREPCACHESIZE = 20 * 1024 * 1024 * 1024
+# Parallel replacements for the decompressors rpm uses in %setup, in order
+# of preference, keyed by the rpm macro pointing at the tool
+PARALLELDECOMPRESSORS = {'__gzip': ['pigz'],
+                         '__bzip2': ['lbzip2', 'pbzip2']}
+# Per module record of the packages each build produced
+ARTIFACTSFILE = '.build-artifacts'
+# Where rpmlint results are cached
+LINTCACHE = os.path.expanduser('~/.cache/fedpkg/rpmlint')
+# rpmlint configuration and filter files, part of the lint cache key
+LINTCONFIGS = ['/etc/rpmlint', '/etc/xdg/rpmlint', '/usr/share/rpmlint',
+               os.path.expanduser('~/.config/rpmlint'),
+               os.path.expanduser('~/.rpmlintrc')]
+# Where the BuildRequires and Provides parsed from specs are cached
+DEPCACHE = os.path.expanduser('~/.cache/fedpkg/specdeps')
+# How many builds build_queue runs side by side unless told otherwise
+BUILDQUEUEBUILDS = 4
+# Where the history of local build timings is kept
+STATSDB = os.path.expanduser('~/.local/share/fedpkg/buildstats.db')
+# RAM backed directories to put build trees in, in order of preference
+TMPFSDIRS = ['/dev/shm', '/tmp']
+# A build tree on tmpfs needs this many times the size of the sources, and
+# at least TMPFSMINSIZE bytes
+TMPFSFACTOR = 10
+TMPFSMINSIZE = 1024 * 1024 * 1024
+# Where mirrors of module repos are kept to clone from by reference
+MIRRORCACHE = os.path.expanduser('~/.cache/fedpkg/mirrors')
+# Where remote branch heads are cached, and for how long in seconds.  A
+# checkout fetched within the same time is trusted for its remote refs.
+HEADCACHE = os.path.expanduser('~/.cache/fedpkg/heads')
+HEADCACHETTL = 300
+# Diffs touching more files than this skip rename detection, which is
+# quadratic in the number of added and deleted files
+DIFFRENAMEMAX = 5000
+# Most files to look for inexact renames among, git's own default.  Bigger
+# diffs only get exact renames
+DIFFRENAMELIMIT = 1000
+# Directory of a module checkout holding a worktree per dist branch, and
+# the link in it to the one switched to last
+WORKTREEDIR = '.branches'
+WORKTREELINK = 'current'
+# Share one ssh connection per remote host between git commands, kept open
+# for SSHCONTROLPERSIST seconds after its last use
+SSHMULTIPLEX = True
+SSHCONTROLDIR = os.path.expanduser('~/.cache/fedpkg/ssh')
+SSHCONTROLPERSIST = 600
+# Payload compression for fast local builds, and the Distribution tag that
+# marks their output as not fit for release
+FASTPAYLOAD = 'w1.gzdio'
+FASTDISTRIBUTION = 'fedpkg fast local build - not for release'
+# The rpmbuild stages we can resume from, in the order they run
+BUILDSTAGES = ['prep', 'build', 'install']
+# Spec lines that start a new section
+SPECSECTIONS = re.compile('^%(prep|build|install|check|clean|files|changelog|'
+                          'package|description|pre|post|preun|postun|'
+                          'pretrans|posttrans|trigger\w*|verifyscript)\\b')
 
 # Define our own error class
 class FedpkgError(Exception):
@@ -55,18 +140,36 @@ log = logging.getLogger("fedpkg")
 # Add the null handler
 log.addHandler(h)
 
+def _setup_ssh():
+    """Have git reuse a control master ssh connection per remote host
+
+    Sets GIT_SSH_COMMAND for this process and its children, unless ssh
+    multiplexing is turned off or the user already picked an ssh command.
+    A master exits by itself SSHCONTROLPERSIST seconds after its last
+    session, until then later fedpkg runs share it too.  Call it before
+    starting threads that run git.
+
+    """
+
+    if not SSHMULTIPLEX or 'GIT_SSH_COMMAND' in os.environ or \
+       'GIT_SSH' in os.environ:
+        return
+    _ensure_dir(SSHCONTROLDIR, 0700)
+    os.environ['GIT_SSH_COMMAND'] = 'ssh -o ControlMaster=auto ' \
+                                    '-o ControlPath=%s/%%C ' \
+                                    '-o ControlPersist=%s' % \
+                                    (SSHCONTROLDIR, SSHCONTROLPERSIST)
+    log.debug('Using %s for git' % os.environ['GIT_SSH_COMMAND'])
+
 def _find_branch(path=None, repo=None):
     """Returns the active branch name"""
 
     if not path:
         path = os.getcwd()
 
-    # Create the repo from path if no repo passed
+    # Look up the repo from path if no repo passed
     if not repo:
-        try:
-            repo = git.Repo(path)
-        except git.errors.InvalidGitRepositoryError:
-            raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
+        repo = git_repo(path)
     return(repo.active_branch.name)
 
 # Define some helper functions, they start with _
@@ -89,6 +192,280 @@ def _hash_file(file, hashtype):
     input.close()
     return sum.hexdigest()
 
+def _hash_string(data, hashtype=MANIFESTHASH):
+    """Return the hash of a string given a hash type"""
+
+    try:
+        sum = hashlib.new(hashtype)
+    except ValueError:
+        raise FedpkgError('Invalid hash type: %s' % hashtype)
+    sum.update(data)
+    return sum.hexdigest()
+
+def _read_manifest(manifest):
+    """Return the entries of a manifest file as a dict of name: digest
+
+    The manifest uses the same "digest  name" layout as a sources file.
+
+    Returns an empty dict if the manifest does not exist.
+
+    """
+
+    entries = {}
+    if not os.path.exists(manifest):
+        return entries
+    for line in open(manifest, 'r').readlines():
+        try:
+            digest, name = line.rstrip('\n').split('  ', 1)
+        except ValueError:
+            # A damaged manifest just means we rebuild
+            log.debug('Ignoring malformed manifest line: %s' % line)
+            continue
+        entries[name] = digest
+    return entries
+
+def _manifest_defines(defines):
+    """Return the rpm defines that affect what a build produces
+
+    Leaves out the ones naming MANIFESTSKIPMACROS, so the same inputs give
+    the same manifest in any checkout directory.
+
+    """
+
+    kept = []
+    for define in defines:
+        match = re.match("--define '(\S+)", define)
+        if match and match.group(1) in MANIFESTSKIPMACROS:
+            continue
+        kept.append(define)
+    return kept
+
+def _write_manifest(manifest, entries):
+    """Write a dict of name: digest out to a manifest file"""
+
+    output = open(manifest, 'w')
+    for name in sorted(entries.keys()):
+        output.write('%s  %s\n' % (entries[name], name))
+    output.close()
+
+def _built_files(logfile):
+    """Return the list of packages an rpmbuild run wrote, from its log"""
+
+    if not os.path.exists(logfile):
+        return []
+    output = open(logfile, 'r').read()
+    return re.findall('^Wrote: (.*\.rpm)$', output, re.M)
+
+def _find_executable(name):
+    """Return the full path to an executable in $PATH, or None"""
+
+    for dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        exe = os.path.join(dir, name)
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+def _parallel_decompress_defines():
+    """Return rpm defines pointing the %setup decompressors at parallel tools
+
+    Only tools found on the system are used, anything else is left at the
+    rpm default.
+
+    """
+
+    defines = []
+    for macro, tools in sorted(PARALLELDECOMPRESSORS.items()):
+        for tool in tools:
+            exe = _find_executable(tool)
+            if exe:
+                log.debug('Using %s for %%%s' % (exe, macro))
+                defines.append("--define '%s %s'" % (macro, exe))
+                break
+    # xz accepts --threads since 5.2, but only decompresses in threads
+    # since 5.4, so older ones would just spend a thread
+    xz = _find_executable('xz')
+    if xz:
+        try:
+            proc = subprocess.Popen([xz, '--version'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, error = proc.communicate()
+        except OSError, e:
+            raise FedpkgError(e)
+        # Like "xz (XZ Utils) 5.4.1"
+        match = re.match(r'xz .* (\d+)\.(\d+)', output)
+        if match and (int(match.group(1)), int(match.group(2))) >= (5, 4):
+            log.debug('Using %s -T0 for %%__xz' % xz)
+            defines.append("--define '__xz %s -T0'" % xz)
+    return defines
+
+def _run_rpmlint(cmd):
+    """Run an rpmlint command, returns a tuple of returncode and output"""
+
+    log.debug('Running: %s' % ' '.join(cmd))
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output, error = proc.communicate()
+    except OSError, e:
+        return (-1, str(e))
+    return (proc.returncode, output)
+
+def _rpm_arch(rpmfile):
+    """Return the arch of a package from its file name, 'src' for srpms"""
+
+    return os.path.basename(rpmfile)[:-len('.rpm')].rsplit('.', 1)[-1]
+
+def _read_artifacts(path):
+    """Return the artifact manifest of the module at path
+
+    This is a list of (nvr, arch, file) tuples, with file relative to path,
+    oldest build first.
+
+    """
+
+    artifacts = []
+    manifest = os.path.join(path, ARTIFACTSFILE)
+    if not os.path.exists(manifest):
+        return artifacts
+    for line in open(manifest, 'r').readlines():
+        try:
+            nvr, arch, file = line.rstrip('\n').split('  ', 2)
+        except ValueError:
+            log.debug('Ignoring malformed artifact line: %s' % line)
+            continue
+        artifacts.append((nvr, arch, file))
+    return artifacts
+
+def _write_artifacts(path, artifacts):
+    """Write out the artifact manifest of the module at path"""
+
+    output = open(os.path.join(path, ARTIFACTSFILE), 'w')
+    for artifact in artifacts:
+        output.write('%s  %s  %s\n' % artifact)
+    output.close()
+
+def _record_artifacts(path, nvr, files):
+    """Record the packages a build of nvr produced in the artifact manifest
+
+    Earlier entries for the same nvr and arches are replaced, and the build
+    moves to the end of the manifest as the most recent one.
+
+    """
+
+    built = [(nvr, _rpm_arch(f), os.path.relpath(f, path)) for f in files]
+    arches = set([arch for (n, arch, f) in built])
+    artifacts = [(n, arch, f) for (n, arch, f) in _read_artifacts(path)
+                 if not (n == nvr and arch in arches)]
+    artifacts.extend(built)
+    _write_artifacts(path, artifacts)
+
+def _find_spec(path):
+    """Return the full path of the first spec file found in path, or None"""
+
+    for f in os.listdir(path):
+        if f.endswith('.spec'):
+            return os.path.join(path, f)
+    return None
+
+def _spec_deps(specfile):
+    """Return a tuple of the BuildRequires and Provides names of a spec
+
+    Provides include the names of all the packages the spec builds.
+    Results are cached by the digest of the spec content.
+
+    """
+
+    key = _hash_file(specfile, MANIFESTHASH)
+    cachefile = os.path.join(DEPCACHE, key)
+    buildrequires = []
+    provides = []
+    if os.path.exists(cachefile):
+        for line in open(cachefile, 'r').readlines():
+            kind, name = line.rstrip('\n').split(' ', 1)
+            if kind == 'B':
+                buildrequires.append(name)
+            else:
+                provides.append(name)
+        return (buildrequires, provides)
+    try:
+        spec = rpm.spec(specfile)
+    except ValueError, e:
+        raise FedpkgError('Could not parse %s: %s' % (specfile, e))
+    buildrequires = [name for name in
+                     spec.sourceHeader[rpm.RPMTAG_REQUIRENAME]
+                     # Skip rpmlib(), rich and file dependencies
+                     if not name.startswith(('rpmlib(', '(', '/'))]
+    for pkg in spec.packages:
+        provides.append(pkg.header[rpm.RPMTAG_NAME])
+        provides.extend(pkg.header[rpm.RPMTAG_PROVIDENAME])
+    _ensure_dir(DEPCACHE)
+    tmpfile = '%s.%s' % (cachefile, os.getpid())
+    output = open(tmpfile, 'w')
+    for name in buildrequires:
+        output.write('B %s\n' % name)
+    for name in set(provides):
+        output.write('P %s\n' % name)
+    output.close()
+    os.rename(tmpfile, cachefile)
+    return (buildrequires, provides)
+
+def _tmpfs_dir():
+    """Return the first writable tmpfs mount of TMPFSDIRS, or None"""
+
+    mounts = {}
+    try:
+        for line in open('/proc/mounts', 'r').readlines():
+            fields = line.split()
+            mounts[fields[1]] = fields[2]
+    except IOError:
+        return None
+    for dir in TMPFSDIRS:
+        if mounts.get(dir) == 'tmpfs' and os.access(dir, os.W_OK):
+            return dir
+    return None
+
+def _ensure_dir(path, mode=0777):
+    """Create the directory path and its parents unless it exists
+
+    Safe to call from several threads or processes at once.
+
+    """
+
+    try:
+        os.makedirs(path, mode)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise FedpkgError('Could not create %s: %s' % (path, e))
+
+def _private_dir(path):
+    """Make sure path is a directory only the current user can use
+
+    Creates it with mode 0700 if it does not exist.  Returns False if it
+    exists as anything else, like a symlink or another user's directory.
+
+    """
+
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise FedpkgError('Could not create %s: %s' % (path, e))
+    fsstat = os.lstat(path)
+    return stat.S_ISDIR(fsstat.st_mode) and \
+           fsstat.st_uid == os.getuid() and \
+           not fsstat.st_mode & 077
+
+def _mem_available():
+    """Return the bytes of memory available without swapping, or None"""
+
+    try:
+        for line in open('/proc/meminfo', 'r').readlines():
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
 def _name_from_spec(spec):
     """Return the base package name from the spec."""
 
@@ -106,6 +483,77 @@ def _name_from_spec(spec):
         raise FedpkgError(error)
     return output.split()[0]
 
+def _stream_command(cmd, cwd=None):
+    """Run the given command and yield its output one line at a time
+
+    The output is never held in memory as a whole.  Raises on error once
+    the output has been consumed.
+
+    """
+
+    log.debug('Running %s and streaming output' % ' '.join(cmd))
+    # A file rather than a pipe, so a chatty command can not block on it
+    # while we read its output
+    errors = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=errors, cwd=cwd)
+    except OSError, e:
+        errors.close()
+        raise FedpkgError(e)
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            yield line.rstrip('\n')
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        errors.seek(0)
+        error = errors.read()
+        errors.close()
+    if proc.returncode:
+        raise FedpkgError('Command %s returned code %s with error: %s' %
+                          (' '.join(cmd), proc.returncode, error))
+
+def _diff_args(path, revs=[], stat=False, patch=True):
+    """Return the git diff options for a diff of revs in path
+
+    stat puts a diffstat summary first, patch includes the changes
+    themselves.  Inexact renames are looked for among up to
+    DIFFRENAMELIMIT changed files, and rename detection is turned off when
+    there are more than DIFFRENAMEMAX.
+
+    """
+
+    args = []
+    if stat and patch:
+        args.append('--patch-with-stat')
+    elif stat:
+        args.append('--stat')
+    # Counting the changed files does not need to look at their content
+    cmd = ['git', 'diff', '--name-only', '--no-renames', '-z'] + revs
+    # Any error shows up again in the diff itself
+    devnull = open(os.devnull, 'w')
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=devnull, cwd=path)
+    except OSError, e:
+        raise FedpkgError(e)
+    finally:
+        devnull.close()
+    changed = 0
+    while True:
+        chunk = proc.stdout.read(65536)
+        if not chunk:
+            break
+        changed += chunk.count('\0')
+    proc.wait()
+    if changed > DIFFRENAMEMAX:
+        log.info('Not detecting renames over %s changed files' % changed)
+        args.append('--no-renames')
+    else:
+        args.extend(['-M', '-l%s' % DIFFRENAMELIMIT])
+    return args
+
 def _run_command(cmd, shell=False, env=None, pipe=[], cwd=None):
     """Run the given command.
 
@@ -212,6 +660,66 @@ def _run_command(cmd, shell=False, env=None, pipe=[], cwd=None):
                                error))
     return
 
+def _run_measured(cmd, shell=False, pipe=[]):
+    """Run the given command like _run_command, and measure its memory use
+
+    The command runs from a forked child so that its resource usage can be
+    collected on its own with wait4.
+
+    Raises on error, or returns the peak resident set size in kilobytes of
+    the command, or of the forked fedpkg if that was larger.
+
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    (readfd, writefd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readfd)
+        # Keep the command from holding the pipe open past our exit
+        fcntl.fcntl(writefd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        code = 0
+        try:
+            _run_command(cmd, shell=shell, pipe=pipe)
+        except FedpkgError, e:
+            os.write(writefd, str(e))
+            code = 1
+        except:
+            os.write(writefd, str(sys.exc_info()[1]))
+            code = 1
+        os._exit(code)
+    os.close(writefd)
+    # Drain the error pipe before waiting, a long message would otherwise
+    # block the child in its write
+    error = ''
+    while True:
+        try:
+            data = os.read(readfd, 65536)
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise FedpkgError(e)
+            continue
+        except KeyboardInterrupt:
+            # The child got the interrupt too, wait for it to go
+            continue
+        if not data:
+            break
+        error += data
+    os.close(readfd)
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise FedpkgError(e)
+        except KeyboardInterrupt:
+            continue
+    if status:
+        raise FedpkgError(error)
+    return usage.ru_maxrss
+
 def _verify_file(file, hash, hashtype):
     """Given a file, a hash of that file, and a hashtype, verify.
 
@@ -226,15 +734,6 @@ def _verify_file(file, hash, hashtype):
         return True
     return False
 
-def _newer(file1, file2):
-    """Compare the last modification time of the given files
-
-    Returns True is file1 is newer than file2
-
-    """
-
-    return os.path.getmtime(file1) > os.path.getmtime(file2)
-
 def get_rpm_header(f, ts=None):
     """Return the rpm header."""
     if ts is None:
@@ -281,68 +780,146 @@ def _get_build_arches_from_srpm(srpm, arches):
         raise FedpkgError('No compatible build arches found in %s' % srpm)
     return archlist
 
-def _list_branches(path=None, repo=None):
-    """Returns a tuple of local and remote branch names"""
+def _find_git_dir(path):
+    """Return the git dir holding the refs of the checkout at path, or None
 
-    if not path:
-        path = os.getcwd()
-    # Create the repo from path if no repo passed
-    if not repo:
-        try:
-            repo = git.Repo(path)
-        except git.errors.InvalidGitRepositoryError:
-            raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
-    log.debug('Listing refs')
-    refs = repo.refs
-    # Sort into local and remote branches
-    remotes = []
-    locals = []
+    Follows the gitdir files of linked worktrees to the common git dir.
+
+    """
+
+    gitdir = os.path.join(path, '.git')
+    if os.path.isfile(gitdir):
+        line = open(gitdir, 'r').read().strip()
+        if not line.startswith('gitdir: '):
+            return None
+        gitdir = os.path.join(path, line[len('gitdir: '):])
+    if not os.path.isdir(gitdir):
+        return None
+    commondir = os.path.join(gitdir, 'commondir')
+    if os.path.exists(commondir):
+        gitdir = os.path.join(gitdir, open(commondir, 'r').read().strip())
+    return os.path.normpath(gitdir)
+
+def _read_refs(gitdir):
+    """Return a tuple of sets of local and remote branch names in gitdir
+
+    Reads packed-refs and the loose refs directly instead of going through
+    git.  Remote branch names are like origin/f15/master.
+
+    """
+
+    refs = set()
+    packed = os.path.join(gitdir, 'packed-refs')
+    if os.path.exists(packed):
+        for line in open(packed, 'r').readlines():
+            # Skip the header and the peeled tag lines
+            if line.startswith(('#', '^')):
+                continue
+            fields = line.split()
+            if len(fields) == 2:
+                refs.add(fields[1])
+    for top in ('refs/heads', 'refs/remotes'):
+        for root, dirs, files in os.walk(os.path.join(gitdir, top)):
+            for f in files:
+                if f.endswith('.lock'):
+                    continue
+                refs.add(os.path.relpath(os.path.join(root, f), gitdir))
+    locals = set()
+    remotes = set()
     for ref in refs:
-        if type(ref) == git.Head:
-            log.debug('Found local branch %s' % ref.name)
-            locals.append(ref.name)
-        elif type(ref) == git.RemoteReference:
-            if ref.name == 'origin/HEAD':
-                log.debug('Skipping remote branch alias origin/HEAD')
-                continue # Not useful in this context
-            log.debug('Found remote branch %s' % ref.name)
-            remotes.append(ref.name)
+        if ref.startswith('refs/heads/'):
+            locals.add(ref[len('refs/heads/'):])
+        elif ref.startswith('refs/remotes/'):
+            remotes.add(ref[len('refs/remotes/'):])
+    # Not useful in this context
+    remotes.discard('origin/HEAD')
     return (locals, remotes)
 
-def _srpmdetails(srpm):
-    """Return a tuple of package name, package files, and upload files."""
+def _list_refs(path=None, repo=None):
+    """Returns a tuple of sets of local and remote branch names"""
 
-    # get the name
-    cmd = ['rpm', '-qp', '--qf', '%{NAME}', srpm]
-            # Run the command
-    log.debug('Running: %s' % ' '.join(cmd))
+    if not path:
+        path = os.getcwd()
+    if repo:
+        gitdir = _find_git_dir(repo.working_tree_dir)
+    else:
+        gitdir = _find_git_dir(path)
+    if gitdir:
+        log.debug('Reading refs from %s' % gitdir)
+        return _read_refs(gitdir)
+    # Not at the top of a checkout, let git find the repo
+    log.debug('Listing refs')
+    cmd = ['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+           'refs/remotes']
     try:
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+                                stderr=subprocess.PIPE, cwd=path)
         output, error = proc.communicate()
     except OSError, e:
         raise FedpkgError(e)
-    name = output
-    if error:
-        raise FedpkgError('Error querying srpm: %s' % error)
+    if proc.returncode:
+        raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
+    locals = set()
+    remotes = set()
+    for ref in output.split():
+        if ref.startswith('refs/heads/'):
+            locals.add(ref[len('refs/heads/'):])
+        elif ref.startswith('refs/remotes/'):
+            remotes.add(ref[len('refs/remotes/'):])
+    remotes.discard('origin/HEAD')
+    return (locals, remotes)
+
+def _list_branches(path=None, repo=None):
+    """Returns a tuple of local and remote branch names"""
+
+    (locals, remotes) = _list_refs(path, repo)
+    return (sorted(locals), sorted(remotes))
+
+def _fetch_history(repo):
+    """Fetch the history and tags a shallow clone of repo left out"""
+
+    if not os.path.exists(os.path.join(repo.git_dir, 'shallow')):
+        return
+    _setup_ssh()
+    log.info('Fetching the history missing from the shallow clone')
+    try:
+        repo.git.fetch('--unshallow', '--tags')
+    except git.errors.GitCommandError, e:
+        raise FedpkgError('Could not fetch history: %s' % e)
+    _invalidate(repo.working_tree_dir)
+
+def _fetch_branch(repo, branch):
+    """Start tracking remote branch in a single branch clone of repo
+
+    Returns True if the branch exists remotely and was fetched.
+
+    """
+
+    _setup_ssh()
+    try:
+        if not repo.git.ls_remote('origin', 'refs/heads/%s' % branch):
+            return False
+        log.info('Fetching %s missing from the single branch clone' % branch)
+        repo.git.remote('set-branches', '--add', 'origin', branch)
+        repo.git.fetch('origin')
+    except git.errors.GitCommandError, e:
+        raise FedpkgError('Could not fetch %s: %s' % (branch, e))
+    return True
+
+def _srpmdetails(srpm, hdr=None):
+    """Return a tuple of package name, package files, and upload files."""
 
-    # now get the files and upload files
+    if hdr is None:
+        try:
+            hdr = get_rpm_header(srpm)
+        except rpm.error, e:
+            raise FedpkgError('Error querying srpm: %s' % e)
+    name = hdr[rpm.RPMTAG_NAME]
+
+    # Sort the files by their extension
     files = []
     uploadfiles = []
-    cmd = ['rpm', '-qpl', srpm]
-    log.debug('Running: %s' % ' '.join(cmd))
-    try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        output, error = proc.communicate()
-    except OSError, e:
-        raise FedpkgError(e)
-    if error:
-        raise FedpkgError('Error querying srpm:' % error)
-    # Doing a strip and split here as splitting on \n gets me an extra entry
-    contents = output.strip().split('\n')
-    # Cycle through the stuff and sort correctly by its extension
-    for file in contents:
+    for file in hdr[rpm.RPMTAG_BASENAMES]:
         if file.rsplit('.')[-1] in UPLOADEXTS:
             uploadfiles.append(file)
         else:
@@ -350,6 +927,204 @@ def _srpmdetails(srpm):
 
     return((name, files, uploadfiles))
 
+def _payload_offset(fo):
+    """Return where the payload starts in the open rpm file fo"""
+
+    # The lead, then the signature header padded to 8 bytes, then the
+    # header.  Each header is a 16 byte preamble holding the number of
+    # index entries and the size of the data, the 16 byte entries and data.
+    offset = 96
+    for pad in (True, False):
+        fo.seek(offset)
+        preamble = fo.read(16)
+        if len(preamble) != 16 or preamble[:3] != '\x8e\xad\xe8':
+            raise FedpkgError('%s is not an rpm' % fo.name)
+        try:
+            (entries, size) = struct.unpack('>II', preamble[8:])
+        except struct.error, e:
+            raise FedpkgError('%s has a corrupt header: %s' % (fo.name, e))
+        offset += 16 + entries * 16 + size
+        if pad:
+            offset += (8 - offset % 8) % 8
+    return offset
+
+class _PayloadReader(object):
+    """ File like reader decompressing an rpm payload as it is read. """
+
+    def __init__(self, fo, decompressor):
+        self.fo = fo
+        self.decompressor = decompressor
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, size):
+        while len(self.buf) - self.pos < size:
+            try:
+                chunk = self.fo.read(65536)
+                if not chunk:
+                    break
+                # Drop what was read already before growing the buffer
+                self.buf = self.buf[self.pos:] + \
+                           self.decompressor.decompress(chunk)
+            except (zlib.error, IOError, EOFError), e:
+                raise FedpkgError('Corrupt srpm payload in %s: %s' %
+                                  (self.fo.name, e))
+            self.pos = 0
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.fo.close()
+
+class _CommandReader(object):
+    """ File like reader of the output of a command, checked on close. """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        log.debug('Running: %s' % ' '.join(cmd))
+        # Not a pipe, which would block the command once full
+        self.errors = tempfile.TemporaryFile()
+        try:
+            # Python ignores SIGPIPE, let the command die of it again
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                         stderr=self.errors,
+                                         preexec_fn=lambda:
+                                         signal.signal(signal.SIGPIPE,
+                                                       signal.SIG_DFL))
+        except OSError, e:
+            self.errors.close()
+            raise FedpkgError(e)
+
+    def read(self, size):
+        try:
+            return self.proc.stdout.read(size)
+        except IOError, e:
+            raise FedpkgError('Could not read from %s: %s' %
+                              (' '.join(self.cmd), e))
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.errors.seek(0)
+        error = self.errors.read()
+        self.errors.close()
+        # Closing before the end of the output kills it with SIGPIPE
+        if self.proc.returncode and self.proc.returncode != -signal.SIGPIPE:
+            raise FedpkgError('Command %s returned code %s with error: %s' %
+                              (' '.join(self.cmd), self.proc.returncode,
+                               error))
+
+def _srpm_payload(srpm, hdr):
+    """Return a reader for the uncompressed cpio payload of srpm
+
+    gzip and bzip2 payloads are decoded in process, others through
+    rpm2cpio.
+
+    """
+
+    compressor = hdr[rpm.RPMTAG_PAYLOADCOMPRESSOR] or 'gzip'
+    if compressor == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compressor == 'bzip2':
+        decompressor = bz2.BZ2Decompressor()
+    else:
+        return _CommandReader(['rpm2cpio', srpm])
+    fo = open(srpm, 'rb')
+    fo.seek(_payload_offset(fo))
+    return _PayloadReader(fo, decompressor)
+
+def _read_exactly(payload, size):
+    """Read size bytes from payload, raising if it ends early"""
+
+    data = payload.read(size)
+    if len(data) != size:
+        raise FedpkgError('Truncated srpm payload')
+    return data
+
+def _write_entry(payload, size, mode, dest):
+    """Write the next size bytes of payload to dest if they differ from it
+
+    Returns True if dest was written.
+
+    """
+
+    existing = None
+    if os.path.isfile(dest) and os.path.getsize(dest) == size:
+        existing = open(dest, 'rb')
+    tmp = None
+    done = 0
+    try:
+        while done < size:
+            chunk = _read_exactly(payload, min(65536, size - done))
+            if existing and existing.read(len(chunk)) == chunk:
+                done += len(chunk)
+                continue
+            if not tmp:
+                tmp = open('%s.tmp' % dest, 'wb')
+                # Carry over the part that matched
+                if existing:
+                    existing.seek(0)
+                    tmp.write(existing.read(done))
+                    existing.close()
+                    existing = None
+            tmp.write(chunk)
+            done += len(chunk)
+        if not tmp and not existing:
+            # An empty file
+            tmp = open('%s.tmp' % dest, 'wb')
+    finally:
+        if existing:
+            existing.close()
+        if tmp:
+            tmp.close()
+    if not tmp:
+        return False
+    os.chmod(tmp.name, mode & 07777)
+    os.rename(tmp.name, dest)
+    return True
+
+def _extract_payload(payload, path):
+    """Extract the newc cpio archive read from payload into path
+
+    Files whose content did not change are left alone.
+
+    Returns the list of files written.
+
+    """
+
+    written = []
+    while True:
+        header = _read_exactly(payload, 110)
+        if header[:6] != '070701':
+            raise FedpkgError('Unknown cpio format in srpm payload')
+        try:
+            fields = [int(header[i:i + 8], 16) for i in range(6, 110, 8)]
+        except ValueError:
+            raise FedpkgError('Corrupt cpio header in srpm payload')
+        mode = fields[1]
+        size = fields[6]
+        namesize = fields[11]
+        name = _read_exactly(payload, namesize).rstrip('\0')
+        _read_exactly(payload, (4 - (110 + namesize) % 4) % 4)
+        if name == 'TRAILER!!!':
+            break
+        if name.startswith('./'):
+            name = name[2:]
+        name = os.path.normpath(name.lstrip('/'))
+        if name.startswith('..'):
+            raise FedpkgError('Refusing to extract %s' % name)
+        if stat.S_ISREG(mode):
+            dest = os.path.join(path, name)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            if _write_entry(payload, size, mode, dest):
+                written.append(name)
+        else:
+            _read_exactly(payload, size)
+        _read_exactly(payload, (4 - size % 4) % 4)
+    return written
+
 def add_tag(tagname, force=False, message=None, file=None):
     """Add a git tag to the repository
 
@@ -374,9 +1149,122 @@ def add_tag(tagname, force=False, message=None, file=None):
         cmd.extend(['-F', os.path.abspath(file)])
     cmd.append(tagname)
     # make it so
-    _run_command(cmd)
+    try:
+        _run_command(cmd)
+    finally:
+        _invalidate(os.getcwd())
     log.info('Tag \'%s\' was created' % tagname)
 
+def _queue_build(path, logfile, buildjobs, buildargs):
+    """Build the module at path, run in a child process of build_queue()
+
+    All output of the build goes to logfile.  Exits with the result.
+
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    output = open(logfile, 'w')
+    os.dup2(output.fileno(), sys.stdout.fileno())
+    os.dup2(output.fileno(), sys.stderr.fileno())
+    try:
+        os.chdir(path)
+        mymodule = PackageModule(path)
+        mymodule.rpmdefines.append("--define '_smp_mflags -j%s'" % buildjobs)
+        mymodule.local(**buildargs)
+    except FedpkgError, e:
+        log.error('Could not build %s: %s' % (path, e))
+        sys.exit(1)
+    sys.exit(0)
+
+def build_queue(paths, jobs=None, buildjobs=None, logdir=None, deps=None,
+                **buildargs):
+    """Build the modules checked out at paths with shared job slots
+
+    jobs is the number of cpus to use in total, defaults to all of them
+
+    buildjobs is the make -j value of each build, defaults to an even split
+    of jobs between up to BUILDQUEUEBUILDS builds
+
+    logdir is where to put <module>.log files, defaults to a .build-queue.log
+    file in each module
+
+    deps is an optional dict of path to the paths that must build
+    successfully before it, as returned by DepGraph.deps
+
+    Every build holds buildjobs of the jobs slots while it runs, so at most
+    jobs / buildjobs builds run at once.  A failed build does not stop the
+    others, only the builds depending on it.  Remaining arguments are passed
+    on to PackageModule.local().
+
+    Returns a dict of path to build returncode, None for skipped builds.
+
+    """
+
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    if not buildjobs:
+        buildjobs = max(1, jobs // max(1, min(len(paths), BUILDQUEUEBUILDS)))
+    elif buildjobs > jobs:
+        buildjobs = jobs
+    pending = [os.path.abspath(path) for path in paths]
+    # Only dependencies within the queue can be waited for
+    waitfor = {}
+    if deps:
+        for path, required in deps.items():
+            waitfor[os.path.abspath(path)] = set([os.path.abspath(p)
+                                                  for p in required]) & \
+                                             set(pending)
+    running = {}
+    results = {}
+    free = jobs
+    while pending or running:
+        # Skip builds that depend on a failed or skipped one
+        for path in pending[:]:
+            failed = [p for p in waitfor.get(path, ())
+                      if p in results and results[p] != 0]
+            if failed:
+                log.warn('Skipping %s, required %s did not build' %
+                         (path, ' '.join(failed)))
+                pending.remove(path)
+                results[path] = None
+        ready = [path for path in pending
+                 if not [p for p in waitfor.get(path, ()) if p not in results]]
+        if pending and not ready and not running:
+            raise FedpkgError('Circular dependencies between: %s' %
+                              ' '.join(pending))
+        # Hand out slots while we have enough for another build
+        while ready and free >= buildjobs:
+            path = ready.pop(0)
+            pending.remove(path)
+            if logdir:
+                logfile = os.path.join(os.path.abspath(logdir), '%s.log' %
+                                       os.path.basename(path))
+            else:
+                logfile = os.path.join(path, '.build-queue.log')
+            log.info('Building %s, logging to %s' % (path, logfile))
+            proc = multiprocessing.Process(target=_queue_build,
+                                           args=(path, logfile, buildjobs,
+                                                 buildargs))
+            proc.start()
+            running[proc] = path
+            free -= buildjobs
+        if not running:
+            continue
+        time.sleep(0.5)
+        for proc in running.keys():
+            if proc.is_alive():
+                continue
+            proc.join()
+            path = running.pop(proc)
+            free += buildjobs
+            results[path] = proc.exitcode
+            if proc.exitcode:
+                log.warn('Build of %s failed' % path)
+            else:
+                log.info('Build of %s succeeded' % path)
+    return results
+
 def clean(dry=False, useignore=True):
     """Clean a module checkout of untracked files.
 
@@ -398,7 +1286,51 @@ def clean(dry=False, useignore=True):
     _run_command(cmd)
     return
  
-def clone(module, user, path=None, branch=None, bare_dir=None):
+def clean_artifacts(path=None, keep=1, dry=False):
+    """Remove the packages of all but the keep most recent builds
+
+    Only packages listed in the artifact manifest are touched.
+
+    Can optionally perform a dry-run
+
+    Logs output and returns nothing
+
+    """
+
+    if not path:
+        path = os.getcwd()
+    artifacts = _read_artifacts(path)
+    # Builds in manifest order, oldest first
+    nvrs = []
+    for (nvr, arch, file) in artifacts:
+        if nvr in nvrs:
+            nvrs.remove(nvr)
+        nvrs.append(nvr)
+    if keep > 0:
+        keepnvrs = set(nvrs[-keep:])
+    else:
+        keepnvrs = set()
+    kept = []
+    for (nvr, arch, file) in artifacts:
+        if nvr in keepnvrs:
+            kept.append((nvr, arch, file))
+            continue
+        filepath = os.path.join(path, file)
+        for f in (filepath, '%s.manifest' % filepath):
+            if not os.path.exists(f):
+                continue
+            if dry:
+                log.info('Would remove %s' % f)
+            else:
+                log.info('Removing %s' % f)
+                os.remove(f)
+    if not dry:
+        _write_artifacts(path, kept)
+    return
+
+def clone(module, user, path=None, branch=None, bare_dir=None,
+          reference=None, dissociate=False, depth=None, single_branch=False,
+          clonefilter=None):
     """Clone a repo, optionally check out a specific branch.
 
     module is the name of the module to clone
@@ -410,12 +1342,24 @@ def clone(module, user, path=None, branch=None, bare_dir=None):
     bare_dir is the name of a directory to make a bare clone too if this is a
     bare clone. None otherwise.
 
+    reference is an optional local repo to borrow objects from
+
+    dissociate copies the borrowed objects, so the clone does not depend on
+    the reference repo afterwards
+
+    depth is an optional number of commits of history to fetch
+
+    single_branch only fetches the branch being checked out
+
+    clonefilter is an optional partial clone filter, like blob:none
+
     Logs the output and returns nothing.
 
     """
 
     if not path:
         path = os.getcwd()
+    _setup_ssh()
     # construct the git url
     if user:
         giturl = GITBASEURL % {'user': user, 'module': module}
@@ -430,6 +1374,20 @@ def clone(module, user, path=None, branch=None, bare_dir=None):
 
     # Create the command
     cmd = ['git', 'clone']
+    if reference:
+        cmd.extend(['--reference', reference])
+        if dissociate:
+            cmd.append('--dissociate')
+    if depth:
+        cmd.extend(['--depth', str(depth)])
+    if single_branch:
+        cmd.append('--single-branch')
+    elif depth:
+        # --depth implies --single-branch, which would leave the other
+        # dist branches out
+        cmd.append('--no-single-branch')
+    if clonefilter:
+        cmd.append('--filter=%s' % clonefilter)
     # do the clone
     if branch and bare_dir:
         log.debug('Cloning %s bare with branch %s' % (giturl, branch))
@@ -443,20 +1401,133 @@ def clone(module, user, path=None, branch=None, bare_dir=None):
     else:
         log.debug('Cloning %s' % giturl)
         cmd.extend([giturl])
-    _run_command(cmd)
+    _run_command(cmd, cwd=path)
 
     # Set push.default to "tracking"
     if not bare_dir:
-        repo = git.Repo(os.path.join(path, module))
+        repo = git_repo(os.path.join(path, module))
         repo.git.config('--add', 'push.default', 'tracking')
+        _invalidate(os.path.join(path, module))
     return
 
-def clone_with_dirs(module, user, path=None):
+def _update_mirror(module):
+    """Create or refresh the mirror of module in the mirror cache
+
+    Returns the path to the mirror.
+
+    """
+
+    _setup_ssh()
+    mirror = os.path.join(MIRRORCACHE, '%s.git' % module)
+    if os.path.isdir(mirror):
+        log.debug('Updating mirror %s' % mirror)
+        cmd = ['git', '--git-dir', mirror, 'fetch', '--prune', '--quiet']
+    else:
+        _ensure_dir(MIRRORCACHE)
+        log.debug('Creating mirror %s' % mirror)
+        cmd = ['git', 'clone', '--mirror', '--quiet',
+               ANONGITURL % {'module': module}, mirror]
+    _run_command(cmd)
+    return mirror
+
+def _clone_one(module, user, path, branch, mirror, cloneargs):
+    """Clone a single module for clone_many()
+
+    Returns None on success, or an error message.
+
+    """
+
+    try:
+        reference = None
+        if mirror:
+            reference = _update_mirror(module)
+        # The mirror gets pruned, so keep the clone from relying on it
+        clone(module, user, path, branch, reference=reference,
+              dissociate=True, **cloneargs)
+    except (FedpkgError, git.GitCommandError, OSError), e:
+        return str(e)
+    return None
+
+def clone_many(modules, user, path=None, branch=None, jobs=None,
+               mirror=True, **cloneargs):
+    """Clone several modules at once
+
+    jobs is the number of clones to run at once, defaults to the number of
+    cpus
+
+    mirror clones each module by reference to a local mirror of it, which
+    is created or brought up to date first.  The objects are copied from
+    the mirror, so the clones keep working when it is pruned or removed
+
+    A failed clone does not stop the others.  Remaining arguments are passed
+    on to clone().
+
+    Returns a dict of module to None for success or an error message.
+
+    """
+
+    if not path:
+        path = os.getcwd()
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    if mirror:
+        _ensure_dir(MIRRORCACHE)
+    _setup_ssh()
+    pool = multiprocessing.pool.ThreadPool(max(min(jobs, len(modules)), 1))
+    try:
+        errors = pool.map(lambda module: _clone_one(module, user, path,
+                                                    branch, mirror,
+                                                    cloneargs),
+                          modules)
+    finally:
+        pool.close()
+    results = dict(zip(modules, errors))
+    for module in modules:
+        if results[module]:
+            log.warn('Could not clone %s: %s' % (module, results[module]))
+        else:
+            log.info('Cloned %s' % module)
+    return results
+
+def _clone_branch(top_path, repo_path, branch, giturl, shared=False):
+    """Locally clone branch of the bare repo_path into a subdir of top_path
+
+    Returns None on success, or an error message.
+
+    """
+
+    branch_dir = branch.split('/master')[0]
+    try:
+        # Make a local clone for our branch
+        cloneargs = ['--branch', branch]
+        if shared:
+            # Borrow the objects of the bare repo instead of copying them
+            cloneargs.append('--shared')
+        git.Git(top_path).clone(*(cloneargs + [repo_path, branch_dir]))
+
+        # Set the origin correctly
+        branch_git = git.Git(os.path.join(top_path, branch_dir))
+        branch_git.config("--replace-all", "remote.origin.url", giturl)
+        branch_git.config('--add', 'push.default', 'tracking')
+    except (git.GitCommandError, OSError), e:
+        return 'Could not locally clone %s from %s: %s' % (branch, repo_path,
+                                                          e)
+    return None
+
+def clone_with_dirs(module, user, path=None, shared=False, jobs=None,
+                    depth=None):
     """Clone a repo old style with subdirs for each branch.
 
     module is the name of the module to clone
 
-    gitargs is an option list of arguments to git clone
+    shared keeps the bare repo as the object store of all the branch
+    checkouts, instead of giving each of them a full copy
+
+    jobs is the number of branches to check out at once, defaults to the
+    number of cpus
+
+    depth is passed on to clone() for the bare clone.  There is no partial
+    clone filter, the local branch clones need every blob of the bare repo
 
     """
 
@@ -464,7 +1535,6 @@ def clone_with_dirs(module, user, path=None):
         path = os.getcwd()
     # Get the full path of, and git object for, our directory of branches
     top_path = os.path.join(path, module)
-    top_git = git.Git(top_path)
     repo_path = os.path.join(top_path, 'fedpkg.git')
 
     # construct the git url
@@ -481,7 +1551,7 @@ def clone_with_dirs(module, user, path=None):
                 (module, e))
 
     # Create a bare clone first. This gives us a good list of branches
-    clone(module, user, top_path, bare_dir=repo_path)
+    clone(module, user, top_path, bare_dir=repo_path, depth=depth)
     # Get the full path to, and a git object for, our new bare repo
     repo_git = git.Git(repo_path)
 
@@ -489,23 +1559,24 @@ def clone_with_dirs(module, user, path=None):
     branches = [x for x in repo_git.branch().split() if x != "*" and
             re.match(BRANCHFILTER, x)]
 
-    for branch in branches:
-        try:
-            # Make a local clone for our branch
-            top_git.clone("--branch", branch, repo_path,
-                          branch.split('/master')[0])
-
-            # Set the origin correctly
-            branch_path = os.path.join(top_path, branch.split('/master')[0])
-            branch_git = git.Git(branch_path)
-            branch_git.config("--replace-all", "remote.origin.url", giturl)
-            branch_git.config('--add', 'push.default', 'tracking')
-        except (git.GitCommandError, OSError), e:
-            raise FedpkgError('Could not locally clone %s from %s: %s' %
-                    (branch, repo_path, e))
-
-    # We don't need this now. Ignore errors since keeping it does no harm
-    shutil.rmtree(repo_path, ignore_errors=True)
+    # The clones are local, so check them out side by side
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    pool = multiprocessing.pool.ThreadPool(max(min(jobs, len(branches)), 1))
+    try:
+        errors = pool.map(lambda branch: _clone_branch(top_path, repo_path,
+                                                       branch, giturl, shared),
+                          branches)
+    finally:
+        pool.close()
+    errors = [error for error in errors if error]
+    if errors:
+        raise FedpkgError('\n'.join(errors))
+
+    # The shared clones need the bare repo, otherwise we don't need it now.
+    # Ignore errors since keeping it does no harm
+    if not shared:
+        shutil.rmtree(repo_path, ignore_errors=True)
 
     # consistent with clone method since the commands should return 0 when
     # successful.
@@ -547,7 +1618,10 @@ def commit(path=None, message=None, file=None, files=[]):
     else:
         cmd.extend(files)
     # make it so
-    _run_command(cmd, cwd=path)
+    try:
+        _run_command(cmd, cwd=path)
+    finally:
+        _invalidate(path or os.getcwd())
     return
 
 def delete_tag(tagname, path=None):
@@ -556,10 +1630,13 @@ def delete_tag(tagname, path=None):
     if not path:
         path = os.getcwd()
     cmd = ['git', 'tag', '-d', tagname]
-    _run_command(cmd, cwd=path)
+    try:
+        _run_command(cmd, cwd=path)
+    finally:
+        _invalidate(path)
     log.info ('Tag %s was deleted' % tagname)
 
-def diff(path, cached=False, files=[]):
+def diff(path, cached=False, files=[], stat=False, patch=True):
     """Excute a git diff
 
     optionally diff the cached or staged changes
@@ -567,45 +1644,185 @@ def diff(path, cached=False, files=[]):
     Takes an optional list of files to diff relative to the module base
     directory
 
-    Logs the output and returns nothing
+    Optionally show a diffstat summary first, or only the summary when
+    patch is False
+
+    Streams the output to a tty, or logs it line by line, and returns
+    nothing
 
     """
 
-    # Things work better if we're in our module directory
-    oldpath = os.getcwd()
-    os.chdir(path)
     # build up the command
-    cmd = ['git', 'diff']
+    revs = []
     if cached:
-        cmd.append('--cached')
+        revs.append('--cached')
+    cmd = ['git', 'diff'] + _diff_args(path, revs, stat, patch) + revs
     if files:
+        cmd.append('--')
         cmd.extend(files)
 
-    # Run it!
-    _run_command(cmd)
-    # popd
-    os.chdir(oldpath)
+    # Run it!  git pages the output itself on a tty
+    if sys.stdout.isatty():
+        _run_command(cmd, cwd=path)
+        return
+    for line in _stream_command(cmd, cwd=path):
+        log.info(line)
     return
 
-def get_latest_commit(module):
-    """Discover the latest commit has for a given module and return it"""
+def _read_head_cache(ttl):
+    """Return the cached remote heads younger than ttl seconds
+
+    Returns a dict of (module, branch) to commit hash.
+
+    """
+
+    heads = {}
+    if not os.path.exists(HEADCACHE):
+        return heads
+    now = time.time()
+    for line in open(HEADCACHE, 'r').readlines():
+        try:
+            module, branch, commit, stamp = line.split()
+            if now - float(stamp) < ttl:
+                heads[(module, branch)] = commit
+        except ValueError:
+            continue
+    return heads
+
+def _write_head_cache(heads):
+    """Add a dict of (module, branch) to commit hash to the head cache"""
+
+    now = time.time()
+    lines = {}
+    if os.path.exists(HEADCACHE):
+        for line in open(HEADCACHE, 'r').readlines():
+            fields = line.split()
+            if len(fields) == 4:
+                lines[tuple(fields[:2])] = line
+    else:
+        if not os.path.isdir(os.path.dirname(HEADCACHE)):
+            os.makedirs(os.path.dirname(HEADCACHE))
+    for (module, branch), commit in heads.items():
+        lines[(module, branch)] = '%s %s %s %s\n' % (module, branch, commit,
+                                                     now)
+    tmpfile = '%s.%s' % (HEADCACHE, os.getpid())
+    output = open(tmpfile, 'w')
+    output.writelines(lines.values())
+    output.close()
+    os.rename(tmpfile, HEADCACHE)
+
+def _local_heads(path, branches, ttl):
+    """Return the remote heads known to the checkout at path
+
+    Only used when the checkout fetched within ttl seconds.  Returns a dict
+    of branch to commit hash.
+
+    """
+
+    fetchhead = os.path.join(path, '.git', 'FETCH_HEAD')
+    if not os.path.exists(fetchhead) or \
+       time.time() - os.path.getmtime(fetchhead) > ttl:
+        return {}
+    cmd = ['git', 'rev-parse']
+    cmd.extend(['refs/remotes/origin/%s' % branch for branch in branches])
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=path)
+        output, error = proc.communicate()
+    except OSError, e:
+        return {}
+    if proc.returncode:
+        return {}
+    return dict(zip(branches, output.split()))
+
+def _remote_heads(module, branches):
+    """Return the heads of branches of module, with a single ls-remote
+
+    Returns a tuple of a dict of branch to commit hash and an error, if any.
+
+    """
 
-    # This is stupid that I have to use subprocess :/
     url = ANONGITURL % {'module': module}
-    # This cmd below only works to scratch build rawhide
-    # We need something better for epel
-    cmd = ['git', 'ls-remote', url, 'refs/heads/master']
-    try :
+    cmd = ['git', 'ls-remote', url]
+    cmd.extend(['refs/heads/%s' % branch for branch in branches])
+    try:
         proc = subprocess.Popen(cmd, stderr=subprocess.PIPE,
                                 stdout=subprocess.PIPE)
         output, error = proc.communicate()
     except OSError, e:
-        raise FedpkgError(e)
-    if error:
-        raise FedpkgError('Got an error finding head for %s: %s' %
-                          (module, error))
+        return ({}, str(e))
+    if proc.returncode:
+        return ({}, error)
+    heads = {}
+    for line in output.splitlines():
+        commit, ref = line.split()
+        heads[ref[len('refs/heads/'):]] = commit
+    return (heads, None)
+
+def get_latest_commits(wanted, paths=None, jobs=None, ttl=HEADCACHETTL):
+    """Discover the latest commit hashes of many module branches
+
+    wanted is a list of (module, branch) tuples
+
+    paths is an optional dict of module to a local checkout of it.  When the
+    checkout fetched within ttl seconds its remote refs are used instead of
+    asking the remote.
+
+    Answers are cached for ttl seconds.  Modules are looked up jobs at a
+    time, with a single ls-remote for all the branches of a module.
+
+    Returns a dict of (module, branch) to commit hash.  Branches that could
+    not be looked up are left out.
+
+    """
+
+    _setup_ssh()
+    heads = _read_head_cache(ttl)
+    found = dict([(key, heads[key]) for key in wanted if key in heads])
+    # Group what is left by module
+    missing = {}
+    for (module, branch) in wanted:
+        if (module, branch) not in found:
+            missing.setdefault(module, set()).add(branch)
+
+    def lookup(module):
+        branches = sorted(missing[module])
+        heads = {}
+        if paths and module in paths:
+            heads = _local_heads(paths[module], branches, ttl)
+        if len(heads) < len(branches):
+            heads, error = _remote_heads(module, branches)
+            if error:
+                log.warn('Got an error finding heads for %s: %s' %
+                         (module, error))
+        return [((module, branch), heads[branch]) for branch in branches
+                if branch in heads]
+
+    if missing:
+        if not jobs:
+            jobs = multiprocessing.cpu_count() * 4
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(missing)))
+        try:
+            looked_up = pool.map(lookup, missing.keys())
+        finally:
+            pool.close()
+        new = {}
+        for results in looked_up:
+            new.update(dict(results))
+        if new:
+            _write_head_cache(new)
+        found.update(new)
+    return found
+
+def get_latest_commit(module, branch='master'):
+    """Discover the latest commit has for a given module and return it"""
+
+    commits = get_latest_commits([(module, branch)])
+    if (module, branch) not in commits:
+        raise FedpkgError('Could not find head of %s for %s' %
+                          (branch, module))
     # Return the hash sum
-    return output.split()[0]
+    return commits[(module, branch)]
 
 def import_srpm(srpm, path=None):
     """Import the contents of an srpm into a repo.
@@ -629,67 +1846,154 @@ def import_srpm(srpm, path=None):
     if not os.path.exists(srpm):
         raise FedpkgError('File not found.')
     # bail if we're dirty
-    try:
-        repo = git.Repo(path)
-    except git.errors.InvalidGitRepositoryError:
-        raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
-    if repo.is_dirty():
+    repo = git_repo(path)
+    session = git_session(path)
+    if session.is_dirty():
         raise FedpkgError('There are uncommitted changes in your repo')
-    # Get the details of the srpm
-    name, files, uploadfiles = _srpmdetails(srpm)
+    # Get the details of the srpm, reading its header only once
+    try:
+        hdr = get_rpm_header(srpm)
+    except rpm.error, e:
+        raise FedpkgError('Error querying srpm: %s' % e)
+    name, files, uploadfiles = _srpmdetails(srpm, hdr)
 
     # Need a way to make sure the srpm name matches the repo some how.
 
-    # Get a list of files we're currently tracking
-    ourfiles = repo.git.ls_files().split('\n')
-    # Trim out sources and .gitignore
-    try:
-        ourfiles.remove('.gitignore')
-        ourfiles.remove('sources')
-    except ValueError:
-        pass
-    try:
-        ourfiles.remove('sources')
-    except ValueError:
-        pass
-
-    # Things work better if we're in our module directory
-    oldpath = os.getcwd()
-    os.chdir(path)
+    # Get a set of files we're currently tracking, less sources and
+    # .gitignore
+    ourfiles = set(session.ls_files())
+    ourfiles.difference_update(['.gitignore', 'sources'])
 
-    # Look through our files and if it isn't in the new files, remove it.
-    for file in ourfiles:
-        if file not in files:
+    # Work with full paths and git commands run in the module, rather than
+    # changing directory, so imports can run in threads
+    path = os.path.abspath(path)
+    try:
+        # If a tracked file isn't in the new files, remove it.
+        unused = sorted(ourfiles.difference(files))
+        for file in unused:
             log.info("Removing no longer used file: %s" % file)
-            rv = repo.index.remove([file])
-            os.remove(file)
-
-    # Extract new files
-    cmd = ['rpm2cpio', srpm]
-    # We have to force cpio to copy out (u) because git messes with
-    # timestamps
-    cmd2 = ['cpio', '-iud', '--quiet']
-
-    rpmcall = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    cpiocall = subprocess.Popen(cmd2, stdin=rpmcall.stdout)
-    output, err = cpiocall.communicate()
-    if output:
-        log.debug(output)
-    if err:
-        os.chdir(oldpath)
-        raise FedpkgError("Got an error from rpm2cpio: %s" % err)
-
-    # And finally add all the files we know about (and our stock files)
-    for file in ('.gitignore'):
-        if not os.path.exists(file):
-            # Create the file
-            open(file, 'w').close()
-        files.append(file)
-    rv = repo.index.add(files)
+        if unused:
+            repo.git.rm('-q', '--', *unused)
+
+        # Extract new files straight from the payload, rewriting only the
+        # ones that changed.  Upload files land where upload() reads them.
+        payload = _srpm_payload(srpm, hdr)
+        try:
+            written = _extract_payload(payload, path)
+        finally:
+            payload.close()
+        log.debug('Wrote %s changed files' % len(written))
+
+        # And finally add all the files we know about (and our stock files)
+        for file in ('.gitignore',):
+            if not os.path.exists(os.path.join(path, file)):
+                # Create the file
+                open(os.path.join(path, file), 'w').close()
+            files.append(file)
+        repo.git.add('--', *files)
+    except git.errors.GitCommandError, e:
+        raise FedpkgError('Could not stage the srpm contents: %s' % e)
+    finally:
+        _invalidate(path)
     # Return to the caller and let them take it from there.
-    os.chdir(oldpath)
     return(uploadfiles)
 
+def _read_import_manifest(manifest):
+    """Return the (srpm, path) pairs listed in an import manifest
+
+    Each line names an srpm and the module checkout to import it into,
+    separated by whitespace.  Relative names are taken from the directory
+    of the manifest.  Empty lines and lines starting with # are skipped.
+
+    """
+
+    base = os.path.dirname(os.path.abspath(manifest))
+    entries = []
+    try:
+        lines = open(manifest, 'r').readlines()
+    except IOError, e:
+        raise FedpkgError('Could not read %s: %s' % (manifest, e))
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            srpm, path = line.split()
+        except ValueError:
+            raise FedpkgError('%s:%s: expected an srpm and a module path' %
+                              (manifest, number + 1))
+        entries.append((os.path.join(base, srpm), os.path.join(base, path)))
+    return entries
+
+def _import_one(srpm, path, user, passwd, lookaside, seen):
+    """Import srpm into path and upload its sources for import_batch()
+
+    Returns a dict describing the outcome.
+
+    """
+
+    result = {'srpm': srpm, 'path': path, 'status': 'imported',
+              'uploaded': [], 'error': None}
+    try:
+        uploadfiles = import_srpm(srpm, path=path)
+        mymodule = PackageModule(path)
+        result['module'] = mymodule.module
+        result['uploaded'] = mymodule.upload(uploadfiles, replace=True,
+                                             user=user, passwd=passwd,
+                                             lookaside=lookaside, seen=seen)
+    except (FedpkgError, git.errors.GitCommandError, OSError, IOError), e:
+        log.error('Could not import %s: %s' % (srpm, e))
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    return result
+
+def import_batch(manifest, jobs=None, user=None, passwd=None, report=None):
+    """Import and upload every srpm listed in manifest into its checkout
+
+    jobs is the number of imports to run at once, defaults to the number
+    of cpus.  A source file with the same name and hash as one already
+    uploaded in this batch is not uploaded again.  The uploads share one
+    Lookaside object, which is not a connection pool: every lookup still
+    opens its own curl handle, and the uploads run the curl command.
+
+    Optionally write the results as JSON to the report file.
+
+    Returns a list of dicts with the srpm, path, status (imported or
+    failed), uploaded files and error of each import, in manifest order.
+
+    """
+
+    entries = _read_import_manifest(manifest)
+    if not entries:
+        raise FedpkgError('No srpms listed in %s' % manifest)
+    paths = set()
+    duplicates = set()
+    for (srpm, path) in entries:
+        if path in paths:
+            duplicates.add(path)
+        paths.add(path)
+    if duplicates:
+        raise FedpkgError('More than one srpm for: %s' %
+                          ' '.join(sorted(duplicates)))
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    lookaside = Lookaside()
+    seen = {}
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(entries)))
+    try:
+        results = pool.map(lambda (srpm, path):
+                           _import_one(srpm, path, user, passwd, lookaside,
+                                       seen), entries)
+    finally:
+        pool.close()
+    if report:
+        tmpfile = '%s.tmp' % report
+        output = open(tmpfile, 'w')
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.close()
+        os.rename(tmpfile, report)
+    return results
+
 def list_tag(tagname=None):
     """Create a list of all tags in the repository which match a given tagname.
 
@@ -697,6 +2001,10 @@ def list_tag(tagname=None):
 
     """
 
+    try:
+        _fetch_history(git_repo())
+    except FedpkgError:
+        pass
     cmd = ['git', 'tag']
     cmd.extend(['-l'])
     if tagname != '*':
@@ -704,21 +2012,27 @@ def list_tag(tagname=None):
     # make it so
     _run_command(cmd)
 
-def new(path=None):
-    """Return changes in a repo since the last tag"""
+def new(path=None, stat=False, patch=True):
+    """Return changes in a repo since the last tag
+
+    The diff is returned as a generator of lines rather than one string,
+    with an optional diffstat summary first, or only the summary when
+    patch is False.
+
+    """
 
     if not path:
         path = os.getcwd()
     # setup the repo object based on our path
-    try:
-        repo = git.Repo(path)
-    except git.errors.InvalidGitRepositoryError:
-        raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
+    repo = git_repo(path)
+    # Shallow clones may lack the tag we need
+    _fetch_history(repo)
     # Find the latest tag
-    tag = repo.git.describe('--tags', '--abbrev=0')
+    tag = git_session(path).describe()
     # Now get the diff
     log.debug('Diffing from tag %s' % tag)
-    return repo.git.diff('-M', tag)
+    cmd = ['git', 'diff'] + _diff_args(path, [tag], stat, patch) + [tag]
+    return _stream_command(cmd, cwd=path)
 
 def pull(path=None, rebase=False, norebase=False):
     """Pull changes from the main repository using optional path
@@ -731,12 +2045,16 @@ def pull(path=None, rebase=False, norebase=False):
 
     if not path:
         path = os.getcwd()
+    _setup_ssh()
     cmd = ['git', 'pull']
     if rebase:
         cmd.append('--rebase')
     if norebase:
         cmd.append('--no-rebase')
-    _run_command(cmd, cwd=path)
+    try:
+        _run_command(cmd, cwd=path)
+    finally:
+        _invalidate(path)
     return
  
 def push(path=None):
@@ -744,10 +2062,83 @@ def push(path=None):
 
     if not path:
         path = os.getcwd()
+    _setup_ssh()
     cmd = ['git', 'push']
     _run_command(cmd, cwd=path)
     return
 
+def _find_checkouts(top):
+    """Return the sorted paths of the git checkouts found under top"""
+
+    checkouts = []
+    for root, dirs, files in os.walk(top):
+        if '.git' in dirs or '.git' in files:
+            checkouts.append(root)
+            # Don't look inside a checkout
+            del dirs[:]
+            continue
+        # Skip bare repos like the fedpkg.git of old style clones
+        dirs[:] = [d for d in dirs if not d.endswith('.git')]
+    return sorted(checkouts)
+
+def _sync_one(path, push=False, rebase=False):
+    """Pull or push the checkout at path for sync_tree()
+
+    Returns a tuple of status and git output.
+
+    """
+
+    if push:
+        cmd = ['git', 'push']
+    else:
+        cmd = ['git', 'pull']
+        if rebase:
+            cmd.append('--rebase')
+    # We parse the output, so make sure it is in English
+    env = dict(os.environ)
+    env['LC_ALL'] = 'C'
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, cwd=path, env=env)
+        output, error = proc.communicate()
+    except OSError, e:
+        return ('failed', str(e))
+    if 'CONFLICT' in output or 'could not apply' in output:
+        return ('conflict', output)
+    if proc.returncode:
+        return ('failed', output)
+    if 'Already up to date' in output or 'Already up-to-date' in output or \
+       'Everything up-to-date' in output:
+        return ('unchanged', output)
+    return ('updated', output)
+
+def sync_tree(top, push=False, rebase=False, jobs=None):
+    """Pull, or push, every module checkout found under top
+
+    Optionally rebase the local changes on top of the pulled ones
+
+    jobs is the number of checkouts to sync at once, defaults to four times
+    the number of cpus as the work is mostly waiting on the network
+
+    Returns a dict of checkout path to a tuple of status and git output.
+    The status is one of updated, unchanged, conflict or failed.
+
+    """
+
+    _setup_ssh()
+    checkouts = _find_checkouts(os.path.abspath(top))
+    if not checkouts:
+        raise FedpkgError('No module checkouts found in %s' % top)
+    if not jobs:
+        jobs = multiprocessing.cpu_count() * 4
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(checkouts)))
+    try:
+        results = pool.map(lambda path: _sync_one(path, push, rebase),
+                           checkouts)
+    finally:
+        pool.close()
+    return dict(zip(checkouts, results))
+
 def retire(path, message=None):
     """Delete all tracked files and commit a new dead.package file
 
@@ -857,41 +2248,112 @@ def sources(path, outdir=None):
             raise FedpkgError('%s failed checksum' % file)
     return
 
-def switch_branch(branch, path=None):
+def _exclude(gitdir, pattern):
+    """Have git ignore pattern in the checkouts of gitdir, untracked"""
+
+    exclude = os.path.join(gitdir, 'info', 'exclude')
+    if os.path.exists(exclude):
+        if pattern in open(exclude, 'r').read().split('\n'):
+            return
+    elif not os.path.isdir(os.path.dirname(exclude)):
+        os.makedirs(os.path.dirname(exclude))
+    output = open(exclude, 'a')
+    output.write('%s\n' % pattern)
+    output.close()
+
+def _switch_worktree(repo, branch):
+    """Check branch out in its own worktree of repo, for switch_branch()
+
+    Returns the path of the checkout of branch.
+
+    """
+
+    if branch == WORKTREELINK:
+        raise FedpkgError('%s can not be used as a worktree branch' % branch)
+    gitdir = _find_git_dir(repo.working_tree_dir)
+    if not gitdir or os.path.basename(gitdir) != '.git':
+        raise FedpkgError('%s is not a module checkout' %
+                          repo.working_tree_dir)
+    # The main checkout holds the objects every worktree shares
+    top = os.path.dirname(gitdir)
+    if git_session(top).active_branch() == branch:
+        target = top
+    else:
+        target = os.path.join(top, WORKTREEDIR, branch)
+    if not os.path.exists(target):
+        (locals, remotes) = _list_refs(repo=repo)
+        _exclude(gitdir, '/%s/' % WORKTREEDIR)
+        cmd = ['git', 'worktree', 'add']
+        if branch in locals:
+            cmd.extend([target, branch])
+        else:
+            log.debug('No local branch found, creating a new one')
+            if not 'origin/%s/master' % branch in remotes and \
+               not _fetch_branch(repo, '%s/master' % branch):
+                raise FedpkgError('Unknown remote branch %s' % branch)
+            cmd.extend(['--track', '-b', branch, target,
+                        'origin/%s/master' % branch])
+        try:
+            _run_command(cmd, cwd=top)
+        finally:
+            _invalidate(top)
+    # Retarget the link atomically
+    link = os.path.join(top, WORKTREEDIR, WORKTREELINK)
+    if not os.path.isdir(os.path.dirname(link)):
+        os.makedirs(os.path.dirname(link))
+    tmplink = '%s.tmp' % link
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(target, tmplink)
+    os.rename(tmplink, link)
+    log.info("Branch '%s' is checked out in %s" % (branch, target))
+    return target
+
+def switch_branch(branch, path=None, worktree=False):
     """Switch the working branch
 
     Will create a local branch if one doesn't already exist,
     based on origin/<branch>/master
 
-    Logs output and returns nothing.
+    Optionally leave the current checkout alone and check the branch out
+    in its own worktree under WORKTREEDIR of the module instead, sharing
+    the objects.  The WORKTREELINK link there points to the checkout of
+    the branch switched to last.  Build trees, sources and srpms of each
+    branch stay in place between switches.
+
+    Logs output and returns the path of the checkout of branch.
     """
 
     if not path:
         path = os.getcwd()
 
     # setup the repo object based on our path
-    try:
-        repo = git.Repo(path)
-    except git.errors.InvalidGitRepositoryError:
-        raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
+    repo = git_repo(path)
+
+    if worktree:
+        return _switch_worktree(repo, branch)
 
     # See if the repo is dirty first
-    if repo.is_dirty():
+    session = git_session(path)
+    if session.is_dirty():
         raise FedpkgError('%s has uncommitted changes.' % path)
 
-    # Get our list of branches
-    (locals, remotes) = _list_branches(repo=repo)
+    # Get our sets of branches
+    (locals, remotes) = _list_refs(repo=repo)
 
     if not branch in locals:
         # We need to create a branch
         log.debug('No local branch found, creating a new one')
-        if not 'origin/%s/master' % branch in remotes:
+        if not 'origin/%s/master' % branch in remotes and \
+           not _fetch_branch(repo, '%s/master' % branch):
             raise FedpkgError('Unknown remote branch %s' % branch)
         try:
             log.info(repo.git.checkout('-b', branch, '--track',
                                        'origin/%s/master' % branch))
         except: # this needs to be finer grained I think...
             raise FedpkgError('Could not create branch %s' % branch)
+        finally:
+            _invalidate(path)
     else:
         try:
             output = repo.git.checkout(branch)
@@ -899,8 +2361,163 @@ def switch_branch(branch, path=None):
             log.info("Switched to branch '%s'" % branch)
         except: # This needs to be finer grained I think...
             raise FedpkgError('Could not check out %s' % branch)
-    return
+        finally:
+            _invalidate(path)
+    return path
+
+
+class GitSession(object):
+    """ Cached git state for one checkout.
+
+    The index, config, latest tag and looked up revisions are read once,
+    until invalidate() is called after changing the checkout.  HEAD is read
+    straight from the git dir and is_dirty() is never cached.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.cache = {}
+
+    def _git(self, *args):
+        """Run a git command in the checkout and return its output"""
+
+        cmd = ['git'] + list(args)
+        log.debug('Running: %s' % ' '.join(cmd))
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, cwd=self.path)
+            output, error = proc.communicate()
+        except OSError, e:
+            raise FedpkgError(e)
+        if proc.returncode:
+            raise FedpkgError('Command %s returned code %s with error: %s' %
+                              (' '.join(cmd), proc.returncode, error))
+        return output
+
+    def _cached(self, *args):
+        """Return the output of a git command, running it only once"""
+
+        if args not in self.cache:
+            self.cache[args] = self._git(*args)
+        return self.cache[args]
+
+    def rev_parse(self, name):
+        """Return the sha of the commit name refers to, or None"""
+
+        try:
+            return self._cached('rev-parse', '--verify', '--quiet',
+                                '%s^{commit}' % name).strip()
+        except FedpkgError:
+            return None
+
+    def _git_dir(self):
+        """Return the git dir holding HEAD for the checkout"""
+
+        if 'gitdir' not in self.cache:
+            gitdir = os.path.join(self.path, '.git')
+            if os.path.isfile(gitdir):
+                line = open(gitdir, 'r').read().strip()
+                gitdir = os.path.join(self.path, line[len('gitdir: '):])
+            elif not os.path.isdir(gitdir):
+                gitdir = os.path.join(self.path,
+                                      self._git('rev-parse',
+                                                '--git-dir').strip())
+            self.cache['gitdir'] = gitdir
+        return self.cache['gitdir']
+
+    def active_branch(self):
+        """Return the checked out branch name, or None on a detached HEAD"""
+
+        head = open(os.path.join(self._git_dir(), 'HEAD'), 'r').read().strip()
+        if not head.startswith('ref: refs/heads/'):
+            return None
+        return head[len('ref: refs/heads/'):]
+
+    def config(self, key):
+        """Return the value of a git config key, or None"""
+
+        if 'config' not in self.cache:
+            values = {}
+            for entry in self._git('config', '-z', '--list').split('\0'):
+                if not entry:
+                    continue
+                # Later settings override earlier ones, as in git
+                name, value = (entry.split('\n', 1) + [''])[:2]
+                values[name] = value
+            self.cache['config'] = values
+        return self.cache['config'].get(key)
+
+    def describe(self):
+        """Return the name of the latest tag reachable from HEAD"""
+
+        return self._cached('describe', '--tags', '--abbrev=0').strip()
+
+    def ls_files(self):
+        """Return the list of files in the index"""
+
+        return [f for f in self._cached('ls-files', '-z').split('\0') if f]
+
+    def is_dirty(self):
+        """Return True if tracked files have uncommitted changes
+
+        Always asks git, as it guards against overwriting edits made
+        since the status was cached.
+
+        """
+
+        return self._git('status', '--porcelain', '-z',
+                         '--untracked-files=no') != ''
+
+    def invalidate(self):
+        """Forget the cached state, after the checkout was changed"""
+
+        self.cache.clear()
+
+# Repo objects and sessions by checkout path, shared within the process
+_repos = {}
+_sessions = {}
+
+def git_repo(path=None):
+    """Return the git.Repo of the checkout at optional path
+
+    The same Repo is returned for every spelling of the path until the
+    checkout is changed through pyfedpkg.
+
+    """
+
+    if not path:
+        path = os.getcwd()
+    key = os.path.realpath(path)
+    if key not in _repos:
+        try:
+            repo = git.Repo(path)
+        except (git.errors.InvalidGitRepositoryError,
+                git.errors.NoSuchPathError):
+            raise FedpkgError('%s is not a valid repo (no git checkout)' %
+                              path)
+        _repos.setdefault(key, repo)
+    return _repos[key]
+
+def git_session(path):
+    """Return the GitSession of the checkout at path"""
+
+    path = os.path.realpath(path)
+    if path not in _sessions:
+        _sessions.setdefault(path, GitSession(path))
+    return _sessions[path]
 
+def _invalidate(path):
+    """Forget the Repo and cached state of the checkout at path
+
+    Called after operations that change the checkout.
+
+    """
+
+    path = os.path.realpath(path)
+    _repos.pop(path, None)
+    session = _sessions.get(path)
+    if session:
+        session.invalidate()
 
 class Lookaside(object):
     """ Object for interacting with the lookaside cache. """
@@ -1053,6 +2670,374 @@ class GitIgnore(object):
                 gitignore_file.write(line)
             gitignore_file.close()
 
+class _EvictingCache(object):
+    """ Directory of cache entries, one subdirectory per key, evicted least
+    recently used first once the cache grows past maxsize bytes.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+
+    def _entry_size(self, entry):
+        size = 0
+        for root, dirs, files in os.walk(entry):
+            for f in files:
+                size += os.path.getsize(os.path.join(root, f))
+        return size
+
+    def _evict(self):
+        """Remove the least recently used entries until we fit in maxsize"""
+
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = self._entry_size(entry)
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        entries.sort()
+        while entries and total > self.maxsize:
+            mtime, size, entry = entries.pop(0)
+            log.debug('Evicting %s from the cache' % entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+class BuildCache(_EvictingCache):
+    """ Cache of local build results keyed by a digest of the build inputs.
+
+    Each entry is a directory holding the built packages, laid out relative
+    to the rpm output dir, and the build log.
+    """
+
+    def __init__(self, path=BUILDCACHE, maxsize=BUILDCACHESIZE):
+        _EvictingCache.__init__(self, path, maxsize)
+
+    def restore(self, key, destdir, logfile):
+        """Copy a cached build result into destdir
+
+        Returns the list of restored packages, or None if key is not cached.
+
+        """
+
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return None
+        restored = []
+        for root, dirs, files in os.walk(entry):
+            for f in files:
+                cached = os.path.join(root, f)
+                relpath = os.path.relpath(cached, entry)
+                if relpath == 'build.log':
+                    shutil.copy2(cached, logfile)
+                    continue
+                dest = os.path.join(destdir, relpath)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                if os.path.exists(dest):
+                    os.remove(dest)
+                # Hardlink if we can, it is much cheaper than copying
+                try:
+                    os.link(cached, dest)
+                except OSError:
+                    shutil.copy2(cached, dest)
+                restored.append(dest)
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return restored
+
+    def store(self, key, srcdir, logfile):
+        """Add the packages listed in logfile, found under srcdir, to the cache"""
+
+        built = _built_files(logfile)
+        if not built:
+            log.debug('No packages found in %s, not caching' % logfile)
+            return
+        _ensure_dir(self.path)
+        entry = os.path.join(self.path, key)
+        # Populate a scratch dir and move it in place, so that an
+        # interrupted store never leaves a partial entry behind
+        tmpentry = os.path.join(self.path, '.%s.%s' % (key, os.getpid()))
+        try:
+            for f in built:
+                relpath = os.path.relpath(f, srcdir)
+                dest = os.path.join(tmpentry, relpath)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                shutil.copy2(f, dest)
+            shutil.copy2(logfile, os.path.join(tmpentry, 'build.log'))
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpentry, entry)
+        except (IOError, OSError), e:
+            shutil.rmtree(tmpentry, ignore_errors=True)
+            log.warn('Could not cache build results: %s' % e)
+            return
+        self._evict()
+
+class PrepCache(_EvictingCache):
+    """ Cache of the build trees %prep leaves behind, keyed by the fingerprint
+    of the prep stage.
+
+    Trees are copied in and out with reflinks where the filesystem supports
+    them, so a restore is close to free on btrfs or xfs and falls back to a
+    plain copy elsewhere.
+    """
+
+    def __init__(self, path=PREPCACHE, maxsize=PREPCACHESIZE):
+        _EvictingCache.__init__(self, path, maxsize)
+
+    def _copy_tree(self, src, dest):
+        _run_command(['cp', '-a', '--reflink=auto', src, dest])
+
+    def restore(self, key, destdir):
+        """Copy a cached build tree into destdir
+
+        Returns the list of restored directories, or None if key is not
+        cached.
+
+        """
+
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return None
+        restored = []
+        for d in os.listdir(entry):
+            dest = os.path.join(destdir, d)
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            self._copy_tree(os.path.join(entry, d), dest)
+            restored.append(dest)
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return restored
+
+    def store(self, key, dirs):
+        """Add the given build tree directories to the cache"""
+
+        _ensure_dir(self.path)
+        entry = os.path.join(self.path, key)
+        tmpentry = os.path.join(self.path, '.%s.%s' % (key, os.getpid()))
+        try:
+            os.mkdir(tmpentry)
+            for d in dirs:
+                self._copy_tree(d, os.path.join(tmpentry, os.path.basename(d)))
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpentry, entry)
+        except (FedpkgError, OSError), e:
+            shutil.rmtree(tmpentry, ignore_errors=True)
+            log.warn('Could not cache the prepped tree: %s' % e)
+            return
+        self._evict()
+
+class DepGraph(object):
+    """ BuildRequires graph between a set of module checkouts.
+
+    A module depends on another one in the set when one of its BuildRequires
+    is provided by a package the other one builds.  Specs are parsed in
+    parallel with the rpm bindings and the results cached by spec digest.
+    """
+
+    def __init__(self, paths, jobs=None):
+        self.paths = [os.path.abspath(path) for path in paths]
+        specs = {}
+        for path in self.paths:
+            spec = _find_spec(path)
+            if not spec:
+                raise FedpkgError('%s is not a valid repo (no .spec found)' %
+                                  path)
+            specs[path] = spec
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        # Parse in separate processes, the rpm macro state is global
+        pool = multiprocessing.Pool(jobs)
+        try:
+            parsed = pool.map(_spec_deps, [specs[path] for path in self.paths])
+        finally:
+            pool.close()
+        # Map every provided name to the module providing it
+        providers = {}
+        for path, (buildrequires, provides) in zip(self.paths, parsed):
+            for name in provides:
+                providers.setdefault(name, path)
+        # deps is a dict of module path to the set of module paths it needs
+        self.deps = {}
+        for path, (buildrequires, provides) in zip(self.paths, parsed):
+            self.deps[path] = set([providers[name] for name in buildrequires
+                                   if name in providers]) - set([path])
+
+    def levels(self):
+        """Return the build plan as a list of levels
+
+        Each level is a list of module paths which only depend on modules
+        in earlier levels, so the modules of a level can build in parallel.
+
+        """
+
+        remaining = dict([(path, set(deps)) for (path, deps) in
+                          self.deps.items()])
+        levels = []
+        while remaining:
+            level = sorted([path for (path, deps) in remaining.items()
+                            if not deps])
+            if not level:
+                raise FedpkgError('Circular BuildRequires between: %s' %
+                                  ' '.join(sorted(remaining.keys())))
+            levels.append(level)
+            for path in level:
+                del remaining[path]
+            for deps in remaining.values():
+                deps.difference_update(level)
+        return levels
+
+class BuildStats(object):
+    """ History of local build stage timings in an SQLite database.
+
+    Every run of a build stage is stored with its duration, the peak RSS of
+    the largest process rpmbuild ran, and the size of the packages it wrote,
+    keyed by module, nvr, arch and host.
+    """
+
+    def __init__(self, path=STATSDB):
+        self.path = path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS builds ('
+                        'module TEXT, nvr TEXT, arch TEXT, host TEXT, '
+                        'stage TEXT, short INTEGER, started REAL, '
+                        'duration REAL, maxrss INTEGER, outsize INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS builds_module '
+                        'ON builds (module, stage, started)')
+
+    def add(self, module, nvr, arch, stage, short, started, duration,
+            maxrss, outsize):
+        """Record a run of a build stage"""
+
+        self.db.execute('INSERT INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+                        '?, ?)', (module, nvr, arch, socket.gethostname(),
+                                  stage, int(short), started, duration,
+                                  maxrss, outsize))
+        self.db.commit()
+
+    def history(self, module=None, limit=20):
+        """Return the most recent runs, optionally of a single module
+
+        Rows are tuples of module, nvr, arch, host, stage, short, started,
+        duration, maxrss and outsize, oldest first.
+
+        """
+
+        query = 'SELECT * FROM builds'
+        params = ()
+        if module:
+            query += ' WHERE module = ?'
+            params = (module,)
+        query += ' ORDER BY started DESC LIMIT ?'
+        rows = self.db.execute(query, params + (limit,)).fetchall()
+        rows.reverse()
+        return rows
+
+    def regressions(self, module=None, threshold=1.2, window=5):
+        """Return the stages whose latest run regressed
+
+        A run regressed when it took more than threshold times the median of
+        the window runs before it, for the same module, arch, host and
+        stage.  At least three earlier runs are needed to judge.
+
+        Returns a list of (module, nvr, arch, host, stage, duration, median)
+        tuples.
+
+        """
+
+        query = 'SELECT module, nvr, arch, host, stage, short, duration ' \
+                'FROM builds'
+        params = ()
+        if module:
+            query += ' WHERE module = ?'
+            params = (module,)
+        query += ' ORDER BY started'
+        runs = {}
+        for row in self.db.execute(query, params):
+            key = (row[0], row[2], row[3], row[4], row[5])
+            runs.setdefault(key, []).append(row)
+        regressed = []
+        for key in sorted(runs.keys()):
+            previous = sorted([row[6] for row in runs[key][-window - 1:-1]])
+            if len(previous) < 3:
+                continue
+            latest = runs[key][-1]
+            median = previous[len(previous) / 2]
+            if latest[6] > threshold * median:
+                regressed.append((latest[0], latest[1], latest[2], latest[3],
+                                  latest[4], latest[6], median))
+        return regressed
+
+class LintCache(object):
+    """ Cache of rpmlint results keyed by the digest of the package header.
+
+    The key also covers the rpmlint version and its configuration, so a
+    new rpmlint or changed filters lint everything again.
+    """
+
+    def __init__(self, path=LINTCACHE, configs=[]):
+        self.path = path
+        self.setup = self._setup(LINTCONFIGS + list(configs))
+
+    def _setup(self, configs):
+        """Return a digest of the rpmlint version and configs"""
+
+        try:
+            proc = subprocess.Popen(['rpmlint', '--version'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            version = proc.communicate()[0]
+        except OSError:
+            # Linting fails too then, and failures are not cached
+            version = ''
+        setup = [version]
+        for config in configs:
+            files = [config]
+            if os.path.isdir(config):
+                files = sorted([os.path.join(root, f) for (root, dirs, names)
+                                in os.walk(config) for f in names])
+            for f in files:
+                if os.path.isfile(f):
+                    setup.append('%s  %s' % (_hash_file(f, MANIFESTHASH), f))
+        return _hash_string('\n'.join(setup))
+
+    def key(self, rpmfile, info=False):
+        """Return the cache key for linting rpmfile"""
+
+        hdr = get_rpm_header(rpmfile)
+        digest = hdr[rpm.RPMTAG_SHA1HEADER]
+        if not digest:
+            digest = _hash_file(rpmfile, MANIFESTHASH)
+        if info:
+            return '%s-%s-info' % (digest, self.setup)
+        return '%s-%s' % (digest, self.setup)
+
+    def get(self, key):
+        """Return a cached tuple of returncode and output, or None"""
+
+        entry = os.path.join(self.path, key)
+        if not os.path.exists(entry):
+            return None
+        returncode, output = open(entry, 'r').read().split('\n', 1)
+        return (int(returncode), output)
+
+    def put(self, key, returncode, output):
+        _ensure_dir(self.path)
+        entry = os.path.join(self.path, key)
+        tmpentry = '%s.%s' % (entry, os.getpid())
+        cached = open(tmpentry, 'w')
+        cached.write('%s\n%s' % (returncode, output))
+        cached.close()
+        os.rename(tmpentry, entry)
+
 # Create a class for spec
 class SpecModule:
     def __init__(self, path=None, spec=None):
@@ -1123,7 +3108,7 @@ class SpecModule:
     def _find_md5(self):
         """ find md5 checksum from spec file"""
         # ~/rpm/packages/builder src_md5()
-        spec = open(self.spec, 'r').read().split('\n')
+        spec = open(os.path.join(self.path, self.spec), 'r').read().split('\n')
         reg = re.compile('^# Source(?P<no>\d+)-md5:\s*(?P<sum>[0-9a-f]{32})')
         for l in spec:
             m = re.match(reg, l)
@@ -1136,13 +3121,11 @@ class PackageModule:
     def _findbranch(self):
         """Find the branch we're on"""
 
-        try:
-            localbranch = self.repo.active_branch.name
-        except TypeError, e:
-            raise FedpkgError('Repo in inconsistent state: %s' % e)
-        try:
-            merge = self.repo.git.config('--get', 'branch.%s.merge' % localbranch)
-        except git.errors.GitCommandError, e:
+        localbranch = self.session.active_branch()
+        if not localbranch:
+            raise FedpkgError('Repo in inconsistent state: detached HEAD')
+        merge = self.session.config('branch.%s.merge' % localbranch)
+        if not merge:
             raise FedpkgError('Unable to find remote branch.  Use --dist')
         return(merge.split('/')[2])
 
@@ -1152,6 +3135,156 @@ class PackageModule:
         return subprocess.Popen(['rpm --eval %{_arch}'], shell=True,
                         stdout=subprocess.PIPE).communicate()[0].strip('\n')
 
+    def _record_stats(self, stage, arch, started, maxrss, short=False,
+                      files=[]):
+        """Record the timing of a build stage which started at started
+
+        maxrss is the peak memory use of the stage in kilobytes, as
+        returned by _run_measured().
+
+        files is the list of packages the stage wrote, if any.
+
+        """
+
+        duration = time.time() - started
+        outsize = sum([os.path.getsize(f) for f in files if os.path.exists(f)])
+        try:
+            BuildStats().add(self.module, self.nvr, arch or self.localarch,
+                             stage, short, started, duration, maxrss,
+                             outsize)
+        except (sqlite3.Error, OSError), e:
+            log.warn('Could not record build timings: %s' % e)
+
+    def _spec_sections(self):
+        """Return a dict of spec section name to the text of that section
+
+        Text before the first section is returned as 'preamble'.  Sections
+        that appear more than once (like %files) are concatenated.
+
+        """
+
+        sections = {}
+        name = 'preamble'
+        for line in open(os.path.join(self.path, self.spec), 'r').readlines():
+            m = SPECSECTIONS.match(line)
+            if m:
+                name = m.group(1)
+            sections[name] = sections.get(name, '') + line
+        return sections
+
+    def _stage_fingerprints(self, arch=None):
+        """Return a dict of build stage to a digest of that stage's inputs"""
+
+        sections = self._spec_sections()
+        manifest = self._input_manifest(self.hashtype, self.rpmdefines)
+        # The spec as a whole is covered by the sections below
+        del manifest[self.spec]
+        prep = ['%s  %s' % (manifest[name], name)
+                for name in sorted(manifest.keys())]
+        prep.extend([str(arch), sections.get('preamble', ''),
+                     sections.get('prep', '')])
+        return {'prep': _hash_string('\n'.join(prep)),
+                'build': _hash_string(sections.get('build', '')),
+                'install': _hash_string(sections.get('install', '') +
+                                        sections.get('check', ''))}
+
+    def _record_stages(self, first, last, arch=None):
+        """Record the fingerprints of the stages from first to last
+
+        Stages after last no longer match what is in the build tree, so
+        their fingerprints are dropped.
+
+        """
+
+        stagesfile = os.path.join(self.path, '.build-stages')
+        fingerprints = self._stage_fingerprints(arch)
+        recorded = _read_manifest(stagesfile)
+        # Remember where the tree is, the builddir may move between runs
+        recorded['%builddir'] = _hash_string(self.builddir)
+        for stage in BUILDSTAGES[BUILDSTAGES.index(first):]:
+            if BUILDSTAGES.index(stage) <= BUILDSTAGES.index(last):
+                recorded[stage] = fingerprints[stage]
+            elif stage in recorded:
+                del recorded[stage]
+        _write_manifest(stagesfile, recorded)
+
+    def _incremental(self, target, arch=None):
+        """Run the build up to target, starting at the first changed stage"""
+
+        stagesfile = os.path.join(self.path, '.build-stages')
+        fingerprints = self._stage_fingerprints(arch)
+        recorded = _read_manifest(stagesfile)
+        stages = BUILDSTAGES[:BUILDSTAGES.index(target) + 1]
+        if recorded.get('%builddir') != _hash_string(self.builddir) or \
+           not self._build_tree():
+            log.debug('No build tree left in %s' % self.builddir)
+            recorded = {}
+        changed = [stage for stage in stages
+                   if recorded.get(stage) != fingerprints[stage]]
+        if not changed:
+            log.info('%%%s of %s is up-to-date, nothing to do' %
+                     (target, self.nvr))
+            return
+        start = stages.index(changed[0])
+        # A cached %prep tree lets us skip straight to %build
+        if start == 0 and self._restore_prep(arch, fingerprints['prep']):
+            start = 1
+        if start == 0:
+            log.debug('%prep inputs changed, running a full build')
+            stages = [target]
+            short = False
+        else:
+            log.info('Resuming %s at %%%s' % (self.nvr, stages[start]))
+            stages = stages[start:]
+            short = True
+        for stage in stages:
+            if stage == 'build':
+                self.compile(arch=arch, short=short)
+            else:
+                self.install(arch=arch, short=short)
+        return
+
+    def _restore_prep(self, arch=None, fingerprint=None):
+        """Restore the %prep build tree from the cache
+
+        Returns True if the tree was restored, False if it is not cached.
+
+        """
+
+        if not fingerprint:
+            fingerprint = self._stage_fingerprints(arch)['prep']
+        if not PrepCache().restore(fingerprint, self.builddir):
+            return False
+        log.info('Restored the prepped tree of %s from the cache' % self.nvr)
+        self._record_stages('prep', 'prep', arch)
+        return True
+
+    def _build_tree(self):
+        """Return the untracked directories in the builddir"""
+
+        if not os.path.isdir(self.builddir):
+            return []
+        tracked = set([f.split('/')[0] for f in self.session.ls_files()])
+        dirs = []
+        for d in os.listdir(self.builddir):
+            dirpath = os.path.join(self.builddir, d)
+            if d.startswith('.') or d in tracked or not os.path.isdir(dirpath):
+                continue
+            dirs.append(dirpath)
+        return dirs
+
+    def _store_prep(self, started, arch=None):
+        """Cache the build tree directories %prep created since started"""
+
+        # tar restores directory mtimes, but the ctime still tells us the
+        # directory was (re)created by this run
+        dirs = [d for d in self._build_tree()
+                if os.stat(d).st_ctime >= int(started)]
+        if not dirs:
+            log.debug('No new build tree found after %prep, not caching')
+            return
+        PrepCache().store(self._stage_fingerprints(arch)['prep'], dirs)
+
     def __init__(self, path=None, dist=None):
         # Initiate a PackageModule object in a given path
         # Set some global variables used throughout
@@ -1165,14 +3298,15 @@ class PackageModule:
         self.module = _name_from_spec(os.path.join(self.path, self.spec))
         self.localarch = self._getlocalarch()
         # Setup the repo
-        try:
-            self.repo = git.Repo(path)
-        except git.errors.InvalidGitRepositoryError:
-            raise FedpkgError('%s is not a valid repo (no git checkout)' % path)
+        self.repo = git_repo(path)
+        self.session = git_session(path)
 
+        # Where rpmbuild unpacks and builds the sources
+        self.builddir = path
+        self.tmpfs = False
         self.rpmdefines = ["--define '_sourcedir %s'" % path,
                            "--define '_specdir %s'" % path,
-                           "--define '_builddir %s'" % path,
+                           "--define '_builddir %s'" % self.builddir,
                            "--define '_srcrpmdir %s'" % path,
                            "--define '_rpmdir %s'" % path,
                            ]
@@ -1186,6 +3320,73 @@ class PackageModule:
         # Default to md5 hash type
         self.hashtype = 'md5'
 
+    def parallel_decompress(self):
+        """Have %setup unpack sources with parallel decompressors
+
+        Adds defines for pigz, lbzip2/pbzip2 and threaded xz, for whichever
+        of them are available, to the rpm defines of this module.
+
+        """
+
+        defines = _parallel_decompress_defines()
+        if not defines:
+            log.warn('No parallel decompressors found, using rpm defaults')
+        self.rpmdefines.extend(defines)
+
+    def use_tmpfs(self, buildroot=False):
+        """Move the build tree, and optionally the buildroot, to tmpfs
+
+        Only done when a tmpfs mount is found and it and the free memory
+        can hold TMPFSFACTOR times the size of the sources.  The tree lives
+        in a per module directory so that short-circuit builds still find
+        it.  Packages are written to the module as usual.
+
+        Returns True if the build tree was moved, False otherwise.
+
+        """
+
+        tmpfs = _tmpfs_dir()
+        if not tmpfs:
+            log.warn('No tmpfs found, building in %s' % self.builddir)
+            return False
+        spec = SpecModule(self.path, self.spec)
+        size = 0
+        for url in spec.sourceurl.values():
+            source = os.path.join(self.path, os.path.basename(url))
+            if os.path.exists(source):
+                size += os.path.getsize(source)
+        needed = max(size * TMPFSFACTOR, TMPFSMINSIZE)
+        fsstat = os.statvfs(tmpfs)
+        free = fsstat.f_bavail * fsstat.f_frsize
+        available = _mem_available()
+        if available is not None:
+            free = min(free, available)
+        if free < needed:
+            log.warn('Only %s MiB free on %s, need %s MiB, building in %s' %
+                     (free / 1048576, tmpfs, needed / 1048576, self.builddir))
+            return False
+        # The tmpfs is shared with other users, so only build in a directory
+        # that is ours alone
+        topdir = os.path.join(tmpfs, 'fedpkg-%s' % os.getuid())
+        if not _private_dir(topdir):
+            log.warn('%s is not a private directory of ours, building in %s' %
+                     (topdir, self.builddir))
+            return False
+        builddir = os.path.join(topdir, '%s-%s' %
+                                (self.module, _hash_string(
+                                    os.path.abspath(self.path))[:12]))
+        if not os.path.isdir(builddir):
+            os.mkdir(builddir)
+        log.info('Building in %s' % builddir)
+        self.rpmdefines.remove("--define '_builddir %s'" % self.builddir)
+        self.rpmdefines.append("--define '_builddir %s'" % builddir)
+        self.builddir = builddir
+        self.tmpfs = True
+        if buildroot:
+            self.rpmdefines.append("--define '_buildrootdir %s'" %
+                                   os.path.join(builddir, 'BUILDROOT'))
+        return True
+
     def clog(self):
         """Write the latest spec changelog entry to a clog file"""
 
@@ -1215,15 +3416,20 @@ class PackageModule:
         clogfile.writelines(cloglines)
         return
 
-    def compile(self, arch=None, short=False):
+    def compile(self, arch=None, short=False, incremental=False):
         """Run rpm -bc on a module
 
         optionally for a specific arch, or short-circuit it
 
+        Can optionally only run the stages whose inputs changed since the
+        last run, short-circuiting when %prep is still current.
+
         Logs the output and returns nothing
 
         """
 
+        if incremental:
+            return self._incremental('build', arch)
         # Get the sources
         sources(self.path)
         # setup the rpm command
@@ -1234,8 +3440,14 @@ class PackageModule:
         if short:
             cmd.append('--short-circuit')
         cmd.extend(['-bc', os.path.join(self.path, self.spec)])
+        started = time.time()
         # Run the command
-        _run_command(cmd, shell=True)
+        maxrss = _run_measured(cmd, shell=True)
+        self._record_stats('build', arch, started, maxrss, short)
+        if short:
+            self._record_stages('build', 'build', arch)
+        else:
+            self._record_stages('prep', 'build', arch)
         return
 
     def getver(self):
@@ -1296,19 +3508,26 @@ class PackageModule:
         """Return the git url that would be used for building"""
 
         # Get the commit hash
-        commit = self.repo.iter_commits().next().sha
+        commit = self.session.rev_parse('HEAD')
+        if not commit:
+            raise FedpkgError('%s has no commits' % self.path)
         url = ANONGITURL % {'module': self.module} + '?#%s' % commit
         return url
 
-    def install(self, arch=None, short=False):
+    def install(self, arch=None, short=False, incremental=False):
         """Run rpm -bi on a module
 
         optionally for a specific arch, or short-circuit it
 
+        Can optionally only run the stages whose inputs changed since the
+        last run, short-circuiting when %prep is still current.
+
         Logs the output and returns nothing
 
         """
 
+        if incremental:
+            return self._incremental('install', arch)
         # Get the sources
         sources(self.path)
         # setup the rpm command
@@ -1319,42 +3538,127 @@ class PackageModule:
         if short:
             cmd.append('--short-circuit')
         cmd.extend(['-bi', os.path.join(self.path, self.spec)])
+        started = time.time()
         # Run the command
-        _run_command(cmd, shell=True)
+        maxrss = _run_measured(cmd, shell=True)
+        self._record_stats('install', arch, started, maxrss, short)
+        if short:
+            self._record_stages('install', 'install', arch)
+        else:
+            self._record_stages('prep', 'install', arch)
         return
 
-    def lint(self, info=False):
+    def lint(self, info=False, jobs=None):
         """Run rpmlint over a built srpm
 
+        Only the packages recorded for the current nvr are linted.
+
+        Each package is linted by its own rpmlint process, up to jobs at a
+        time (defaults to the number of cpus).  Results are cached by
+        package header digest, so unchanged packages are not linted again.
+
         Log the output and returns nothing
 
         """
 
+        # Lint exactly what the builds of this nvr produced
+        rpms = [os.path.join(self.path, file) for (nvr, arch, file) in
+                _read_artifacts(self.path) if nvr == self.nvr]
+        rpms = [file for file in rpms if os.path.exists(file)]
         # Make sure we have rpms to run on
-        srpm = "%s-%s-%s.src.rpm" % (self.module, self.ver, self.rel)
-        if not os.path.exists(os.path.join(self.path, srpm)):
+        if not rpms:
             raise FedpkgError('Need to build srpm and rpm first')
-        # Get the possible built arches
-        arches = _get_build_arches_from_srpm(os.path.join(self.path, srpm),
-                                             [self.localarch])
-        rpms = []
-        rpms.extend([os.path.join(self.path, file) for file in
-                     os.listdir(self.path)
-                     if file.endswith('.rpm')])
         cmd = ['rpmlint']
         if info:
             cmd.extend(['-i'])
-        cmd.extend([os.path.join(self.path, srpm)])
-        cmd.extend(rpms)
-        # Run the command
-        _run_command(cmd, shell=True)
+        # Filters kept with the package count as configuration too
+        lintcache = LintCache(configs=[os.path.join(self.path, f) for f in
+                                       os.listdir(self.path)
+                                       if f.endswith('rpmlintrc')])
+        results = {}
+        tolint = []
+        for rpmfile in rpms:
+            key = lintcache.key(rpmfile, info)
+            cached = lintcache.get(key)
+            if cached:
+                log.debug('Using cached rpmlint result for %s' % rpmfile)
+                results[rpmfile] = cached
+            else:
+                tolint.append((rpmfile, key))
+        if tolint:
+            if not jobs:
+                jobs = multiprocessing.cpu_count()
+            pool = multiprocessing.pool.ThreadPool(min(jobs, len(tolint)))
+            try:
+                linted = pool.map(_run_rpmlint, [cmd + [rpmfile] for
+                                                 (rpmfile, key) in tolint])
+            finally:
+                pool.close()
+            for (rpmfile, key), (returncode, output) in zip(tolint, linted):
+                # Only cache real rpmlint runs, not failures to start it
+                if returncode >= 0:
+                    lintcache.put(key, returncode, output)
+                results[rpmfile] = (returncode, output)
+        # Merge the reports, ordered by package
+        failed = []
+        for rpmfile in sorted(results.keys(), key=os.path.basename):
+            returncode, output = results[rpmfile]
+            log.info(output.rstrip('\n'))
+            if returncode:
+                failed.append(os.path.basename(rpmfile))
+        if failed:
+            raise FedpkgError('rpmlint reported problems with: %s' %
+                              ' '.join(failed))
         return
 
-    def local(self, arch=None, hashtype='sha256'):
+    def _eval_macros(self, macros, arch=None):
+        """Return the values of the given rpm macros for arch"""
+
+        cmd = ['rpm']
+        cmd.extend(self.rpmdefines)
+        if arch:
+            cmd.extend(['--target', arch])
+        cmd.extend(['--eval', "'%s'" % '\n'.join(macros)])
+        try:
+            output = subprocess.Popen(' '.join(cmd), shell=True,
+                                      stdout=subprocess.PIPE).communicate()
+        except OSError, e:
+            raise FedpkgError('Could not evaluate macros: %s' % e)
+        return output[0]
+
+    def _build_key(self, arch, hashtype, defines):
+        """Return the digest identifying a local build of the module"""
+
+        manifest = self._input_manifest(hashtype, defines)
+        inputs = ['%s  %s' % (manifest[name], name)
+                  for name in sorted(manifest.keys())]
+        inputs.append('%%arch  %s' % arch)
+        inputs.append(self._eval_macros(BUILDCACHEMACROS, arch))
+        return _hash_string('\n'.join(inputs))
+
+    def _fast_defines(self, debuginfo=True):
+        """Return the rpm defines for a fast, non-release local build"""
+
+        defines = ["--define '_binary_payload %s'" % FASTPAYLOAD,
+                   "--define '_source_payload %s'" % FASTPAYLOAD,
+                   "--define 'distribution %s'" % FASTDISTRIBUTION]
+        if not debuginfo:
+            defines.extend(["--define 'debug_package %{nil}'",
+                            "--define '__strip /bin/true'"])
+        return defines
+
+    def local(self, arch=None, hashtype='sha256', cache=False, fast=False,
+              debuginfo=True):
         """rpmbuild locally for given arch.
 
         Takes arch to build for, and hashtype to build with.
 
+        Can optionally reuse and populate the local build cache.
+
+        Can optionally do a fast build with cheap payload compression and,
+        if debuginfo is False, without debuginfo packages or stripping.
+        Fast builds are tagged as not for release.
+
         Writes output to a log file and logs it to the logger
 
         Returns the returncode from the build call
@@ -1367,36 +3671,85 @@ class PackageModule:
         # Determine arch to build for
         if not arch:
             arch = self.localarch
+        defines = self._hashtype_defines(hashtype)
+        if fast:
+            log.warn('Fast build: packages of %s are not for release' %
+                     self.nvr)
+            defines.extend(self._fast_defines(debuginfo))
+        logfile = os.path.join(self.path,
+                               '.build-%s-%s.log' % (self.ver, self.rel))
+        if cache:
+            buildcache = BuildCache()
+            key = self._build_key(arch, hashtype, defines)
+            restored = buildcache.restore(key, self.path, logfile)
+            if restored:
+                log.info('Restored build of %s for %s from the cache' %
+                         (self.nvr, arch))
+                _record_artifacts(self.path, self.nvr, restored)
+                return
         # build up the rpm command
         cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
-        # This may need to get updated if we ever change our checksum default
-        if not hashtype == 'sha256':
-            cmd.extend(["--define '_source_filedigest_algorithm %s'" % hashtype,
-                        "--define '_binary_filedigest_algorithm %s'" % hashtype])
+        cmd.extend(defines)
         cmd.extend(['--target', arch, '-ba',
                     os.path.join(self.path, self.spec)])
-        logfile = '.build-%s-%s.log' % (self.ver, self.rel)
+        started = time.time()
         # Run the command
-        _run_command(cmd, shell=True, pipe=['tee', logfile])
+        maxrss = _run_measured(cmd, shell=True, pipe=['tee', logfile])
+        built = _built_files(logfile)
+        self._record_stats('local', arch, started, maxrss, files=built)
+        _record_artifacts(self.path, self.nvr, built)
+        # The packages are out, give the memory back
+        if self.tmpfs:
+            shutil.rmtree(self.builddir, ignore_errors=True)
+        if cache:
+            buildcache.store(key, self.path, logfile)
         return
 
-    def upload(self, files, replace=False, user=None, passwd=None):
+    def _upload_file(self, f, user, passwd):
+        """Send the file at path f to the lookaside upload area"""
+
+        # Ensure the new file is readable:
+        os.chmod(f, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        #lookaside.upload_file(self.module, f, file_hash)
+        # For now don't use the pycurl upload function as it does
+        # not produce any progress output.  Cheat and use curl
+        # directly.
+        # This command is stolen from the dist-cvs make file
+        # It assumes and hard codes the cert file name/location
+        cmd = ['curl',
+               '--fail', '-o',
+               '/dev/null', '--show-error', '--progress-bar',
+               '--user', '%s:%s' % (user, passwd),
+               '-T', f, LOOKASIDE_UPLOAD]
+        _run_command(cmd)
+
+    def upload(self, files, replace=False, user=None, passwd=None,
+               lookaside=None, seen=None):
         """Upload source file(s) in the lookaside cache
 
         Can optionally replace the existing tracked sources
 
-        """
+        Optionally share a Lookaside object between uploads, and a seen dict
+        of (file hash, file name) to threading.Event, so an identical file
+        is only uploaded once.  An upload of a file another upload is already
+        sending waits for it, and tries again itself if that one failed.
+
+        Files are relative to the module directory.  Returns the list of
+        files uploaded.
 
-        oldpath = os.getcwd()
-        os.chdir(self.path)
+        """
 
         # Will add new sources to .gitignore if they are not already there.
         gitignore = GitIgnore(os.path.join(self.path, '.gitignore'))
 
-        lookaside = Lookaside()
+        if not lookaside:
+            lookaside = Lookaside()
+        if seen is None:
+            seen = {}
         uploaded = []
         for f in files:
+            # Full paths, as uploads may run in threads
+            f = os.path.join(self.path, f)
             # TODO: Skip empty file needed?
             file_hash = _hash_file(f, self.lookasidehash)
             log.info("Uploading: %s  %s" % (file_hash, f))
@@ -1406,88 +3759,165 @@ class PackageModule:
             if not gitignore.match(file_basename):
                 gitignore.add('/%s' % file_basename)
 
-            if lookaside.file_exists(self.module, file_basename, file_hash):
-                # Already uploaded, skip it:
-                log.info("File already uploaded: %s" % file_basename)
-            else:
-                # Ensure the new file is readable:
-                os.chmod(f, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-                #lookaside.upload_file(self.module, f, file_hash)
-                # For now don't use the pycurl upload function as it does
-                # not produce any progress output.  Cheat and use curl
-                # directly.
-                # This command is stolen from the dist-cvs make file
-                # It assumes and hard codes the cert file name/location
-                cmd = ['curl',
-                       '--fail', '-o',
-                       '/dev/null', '--show-error', '--progress-bar',
-                       '--user', '%s:%s' % (user, passwd),
-                       '-T', f, LOOKASIDE_UPLOAD]
-                _run_command(cmd)
-                uploaded.append(file_basename)
+            key = (file_hash, file_basename)
+            while True:
+                # setdefault checks and claims the file in one step
+                mine = threading.Event()
+                claim = seen.setdefault(key, mine)
+                if claim is mine:
+                    break
+                # Another upload of the same file is running or done
+                claim.wait()
+                # A failed upload drops its claim
+                if seen.get(key) is claim:
+                    break
+            if claim is not mine:
+                log.info("File already uploaded in this batch: %s" %
+                         file_basename)
+                continue
+            try:
+                if lookaside.file_exists(self.module, file_basename,
+                                         file_hash):
+                    # Already uploaded, skip it:
+                    log.info("File already uploaded: %s" % file_basename)
+                else:
+                    self._upload_file(f, user, passwd)
+                    uploaded.append(file_basename)
+            except:
+                # Let the uploads waiting on this one try themselves
+                del seen[key]
+                mine.set()
+                raise
+            mine.set()
 
         # Write .gitignore with the new sources if anything changed:
         gitignore.write()
 
-        rv = self.repo.index.add(['.gitignore'])
-
-        # Change back to original working dir:
-        os.chdir(oldpath)
+        self.repo.git.add('.gitignore')
+        _invalidate(self.path)
 
         # Log some info
         log.info('Uploaded and added to .gitignore: %s' % ' '.join(uploaded))
-        return
+        return uploaded
 
-    def prep(self, arch=None):
+    def prep(self, arch=None, cache=False):
         """Run rpm -bp on a module
 
         optionally for a specific arch
 
+        Can optionally restore the prepped tree from the cache instead of
+        running %prep, and cache it after running %prep.
+
         Logs the output and returns nothing
 
         """
 
         # Get the sources
         sources(self.path)
+        if cache and self._restore_prep(arch):
+            return
         # setup the rpm command
         cmd = ['rpmbuild']
         cmd.extend(self.rpmdefines)
         if arch:
             cmd.extend(['--target', arch])
         cmd.extend(['--nodeps', '-bp', os.path.join(self.path, self.spec)])
+        started = time.time()
         # Run the command
-        _run_command(cmd, shell=True)
+        maxrss = _run_measured(cmd, shell=True)
+        self._record_stats('prep', arch, started, maxrss)
+        self._record_stages('prep', 'prep', arch)
+        if cache:
+            self._store_prep(started, arch)
         return
- 
+
+    def _hashtype_defines(self, hashtype):
+        """Return the rpm defines to build with the given hashtype"""
+
+        defines = list(self.rpmdefines)
+        # This may need to get updated if we ever change our checksum default
+        if not hashtype == 'sha256':
+            defines.extend(["--define '_source_filedigest_algorithm %s'" % hashtype,
+                    "--define '_binary_filedigest_algorithm %s'" % hashtype])
+        return defines
+
+    def _input_manifest(self, hashtype, defines):
+        """Return a dict of digests over everything that goes into a build
+
+        Covers the spec, the tracked patches, the sources, the hashtype and
+        the rpm defines in effect, less the ones that only hold paths or
+        tools.  Inputs not present on disk are left out.
+
+        """
+
+        files = set([self.spec])
+        files.update([f for f in self.session.ls_files()
+                      if f.endswith('.patch')])
+        spec = SpecModule(self.path, self.spec)
+        for url in spec.sourceurl.values() + spec.patchurl.values():
+            files.add(os.path.basename(url))
+        entries = {}
+        for f in files:
+            filepath = os.path.join(self.path, f)
+            if os.path.isfile(filepath):
+                entries[f] = _hash_file(filepath, MANIFESTHASH)
+        entries['%hashtype'] = _hash_string(hashtype)
+        entries['%rpmdefines'] = _hash_string(' '.join(
+                                     _manifest_defines(defines)))
+        return entries
+
+    def _srpm_path(self):
+        """Return the path the srpm of the module is written to"""
+
+        return os.path.join(self.path, "%s-%s-%s.src.rpm" %
+                            (self.module, self.ver, self.rel))
+
+    def srpm_uptodate(self, hashtype=None):
+        """Return True if the srpm was built from the current inputs"""
+
+        srpmname = self._srpm_path()
+        if not os.path.exists(srpmname):
+            return False
+        if not hashtype:
+            hashtype = self.hashtype
+        manifest = self._input_manifest(hashtype,
+                                        self._hashtype_defines(hashtype))
+        return _read_manifest('%s.manifest' % srpmname) == manifest
+
     def srpm(self, hashtype=None):
         """Create an srpm using hashtype from content in the module
     
         Requires sources already downloaded.
+
+        The srpm is only rebuilt when the digests of its inputs differ from
+        the manifest stored next to it.
     
         """
 
-        self.srpmname = os.path.join(self.path,
-                            "%s-%s-%s.src.rpm" % (self.module,
-                                                  self.ver, self.rel))
+        self.srpmname = self._srpm_path()
+        # Figure out which hashtype to use, if not provided one
+        if not hashtype:
+            hashtype = self.hashtype
+        defines = self._hashtype_defines(hashtype)
+        manifestfile = '%s.manifest' % self.srpmname
+        manifest = self._input_manifest(hashtype, defines)
         # See if we need to build the srpm
         if not os.path.exists(self.srpmname):
             log.debug('No srpm found, building one.')
-        elif _newer(self.srpmname, self.spec):
+        elif _read_manifest(manifestfile) == manifest:
             log.debug('srpm is up-to-date, skip rebuilding')
-            # srpm is newer, don't redo it
+            # inputs are unchanged, don't redo it
+            _record_artifacts(self.path, self.nvr, [self.srpmname])
             return
+        else:
+            log.debug('srpm inputs changed, rebuilding')
 
         cmd = ['rpmbuild']
-        cmd.extend(self.rpmdefines)
-        # Figure out which hashtype to use, if not provided one
-        if not hashtype:
-            hashtype = self.hashtype
-        # This may need to get updated if we ever change our checksum default
-        if not hashtype == 'sha256':
-            cmd.extend(["--define '_source_filedigest_algorithm %s'" % hashtype,
-                    "--define '_binary_filedigest_algorithm %s'" % hashtype])
+        cmd.extend(defines)
         cmd.extend(['--nodeps', '-bs', os.path.join(self.path, self.spec)])
         _run_command(cmd, shell=True)
+        _write_manifest(manifestfile, manifest)
+        _record_artifacts(self.path, self.nvr, [self.srpmname])
         return
 
     def unused_patches(self):
@@ -1502,7 +3932,7 @@ class PackageModule:
         # Get the content of spec into memory for fast searching
         spec = open(self.spec, 'r').read()
         # Get a list of files tracked in source control
-        files = self.repo.git.ls_files('--exclude-standard').split()
+        files = self.session.ls_files()
         for file in files:
             # throw out non patches
             if not file.endswith('.patch'):